@@ -5,8 +5,9 @@ Includes both ui instantiation, as well as the logic for populating UI with data
 
 import pickle
 import sys
+from collections import OrderedDict, deque
 
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QTimer
 from PyQt6.QtGui import QBrush, QColor, QDoubleValidator, QFontMetrics, QImage, QIntValidator, QPainter, QPen, QPixmap
 from PyQt6.QtWidgets import (
     QApplication,
@@ -62,18 +63,29 @@ class Gui(QMainWindow):
 
         # how fine scrolling you want the ROI sliders to be. 100 is more than enough typically...
         self.roiSliderGranularity = 100
+        # how long (ms) a slice slider has to settle before the image gets re-rendered while dragging
+        self.sliceSliderThrottleMs = 25
+        # log lines get batched and appended to the log outputs at most every logFlushMs; older lines get dropped
+        self.logFlushMs = 50
+        self.maxLogLines = 5000
 
         # ----- GUI Properties that act as state, in addition to all the gui features that hold state ----- #
         # array of views. so that we can generalize update function for all views
         # should be roi view, shim view, and then basis view
         self.views = []
-        self.viewDataSlice = np.array(
-            [np.nan for _ in range(3)], dtype=object
-        )  # three sets of 2D Slice Data that is actually visualized
+        self.viewDataSlice = np.full(3, np.nan, dtype=object)  # three sets of 2D Slice Data that is actually visualized
 
         # the value range for each view
         self.viewMaxAbs = [0 for _ in range(3)]
 
+        # LRU cache of the already rendered slices, so that scrubbing back over a slice doesn't re-normalize it
+        # cleared whenever the tool's view data changes, see shimTool.viewDataEdits
+        self.pixmapCache = OrderedDict()
+        self.pixmapCacheEdits = None
+        self.pixmapCacheSize = 64
+        # float32 scratch buffer per view for normalizing slices, reallocated only when the slice shape changes
+        self.displayScratch = [None for _ in range(3)]
+
         # start building the state vector for the GUI. These are all the essential data structures that are necessary to reload the app
         self.state = {"checkboxes": {}}
 
@@ -93,8 +105,7 @@ class Gui(QMainWindow):
                 "data",
                 self.shimTool.exsiInstance.examNumber,
             )
-            if not os.path.exists(self.shimTool.localExamRootDir):
-                os.makedirs(self.shimTool.localExamRootDir)
+            os.makedirs(self.shimTool.localExamRootDir, exist_ok=True)
             self.setWindowAndExamNumber(
                 self.shimTool.exsiInstance.examNumber,
                 self.shimTool.exsiInstance.patientName,
@@ -114,6 +125,12 @@ class Gui(QMainWindow):
         # start the PyQt event loop
         sys.exit(self.app.exec())
 
+    def closeEvent(self, event):
+        """Release the cached ssh connection to the scanner host and the solver processes when the window closes."""
+        closeSSHClients()
+        self.shimTool.shutdownPools()
+        super().closeEvent(event)
+
     ##### GUI LAYOUT RELATED FUNCTIONS #####
 
     def initUI(self):
@@ -170,7 +187,13 @@ class Gui(QMainWindow):
         self.centralTabWidget.addTab(self.shimmingTab, "SHIM Control [Not Connected]")
         self.centralTabWidget.addTab(self.basisTab, "Basis/Performance Visualization")
 
-        # Connect the log monitor
+        # Connect the log monitor, lines get buffered and flushed to the log outputs in batches
+        self.pendingLogLines = {self.exsiLogOutput: deque(), self.shimLogOutput: deque()}
+        self.logFlushTimer = QTimer(self)
+        self.logFlushTimer.setSingleShot(True)
+        self.logFlushTimer.setInterval(self.logFlushMs)
+        self.logFlushTimer.timeout.connect(self.flushLogOutputs)
+
         self.exsiLogMonitorThread = LogMonitorThread(self.shimTool.scannerLog)
         self.exsiLogMonitorThread.update_log.connect(partial(self.updateLogOutput, self.exsiLogOutput))
         self.exsiLogMonitorThread.start()
@@ -192,7 +215,7 @@ class Gui(QMainWindow):
 
         # Slider for selecting slices
         self.roiSliceIndexPack = addLabeledSliderAndEntry(
-            imageLayout, "Slice Index (Int): ", self.updateROIImageDisplay
+            imageLayout, "Slice Index (Int): ", self.updateROIImageDisplay, self.sliceSliderThrottleMs
         )
         disableWidgetsInList(self.roiSliceIndexPack)  # start off disabled -- no image is viewed yet!
 
@@ -200,7 +223,7 @@ class Gui(QMainWindow):
         self.roiViewLabel = QLabel()
         self.roiView = ImageViewer(self, self.roiViewLabel)
         self.roiView.setFixedSize(512, 512)  # Set a fixed size for the view
-        self.roiView.setRenderHints(QPainter.RenderHint.Antialiasing | QPainter.RenderHint.SmoothPixmapTransform)
+        self.roiView.setRenderHints(QPainter.RenderHint.SmoothPixmapTransform)
         imageLayout.addWidget(self.roiView, alignment=Qt.AlignmentFlag.AlignCenter)
         imageLayout.addWidget(self.roiViewLabel)
         self.views += [self.roiView]
@@ -266,6 +289,7 @@ class Gui(QMainWindow):
 
         self.exsiLogOutput = QTextEdit()
         self.exsiLogOutput.setReadOnly(True)
+        self.exsiLogOutput.document().setMaximumBlockCount(self.maxLogLines)
         self.exsiLogOutputLabel = QLabel("EXSI Log Output")
 
         layout.addWidget(self.exsiLogOutputLabel)
@@ -314,7 +338,9 @@ class Gui(QMainWindow):
         self.shimVizButtonGroup.idClicked.connect(self.toggleShimImage)
 
         # add the slice selection slider
-        self.shimSliceIndexPack = addLabeledSliderAndEntry(layout, "Slice Index (Int): ", self.updateShimImageAndStats)
+        self.shimSliceIndexPack = addLabeledSliderAndEntry(
+            layout, "Slice Index (Int): ", self.updateShimImageAndStats, self.sliceSliderThrottleMs
+        )
 
         # add another graphics scene visualizer
         # Setup QGraphicsView for image display
@@ -324,7 +350,7 @@ class Gui(QMainWindow):
         layout.addWidget(self.shimView, alignment=Qt.AlignmentFlag.AlignCenter)
         layout.addWidget(self.shimViewLabel)
         self.shimView.setFixedSize(512, 512)  # Set a fixed size for the view
-        self.shimView.setRenderHints(QPainter.RenderHint.Antialiasing | QPainter.RenderHint.SmoothPixmapTransform)
+        self.shimView.setRenderHints(QPainter.RenderHint.SmoothPixmapTransform)
         self.views += [self.shimView]
 
         # add three statistics outputs using another non editable textedit widget
@@ -355,6 +381,7 @@ class Gui(QMainWindow):
         # Add the log output here
         self.shimLogOutput = QTextEdit()
         self.shimLogOutput.setReadOnly(True)
+        self.shimLogOutput.document().setMaximumBlockCount(self.maxLogLines)
         self.shimLogOutputLabel = QLabel("SHIM Log Output")
         layout.addWidget(self.shimLogOutputLabel)
         layout.addWidget(self.shimLogOutput)
@@ -399,13 +426,15 @@ class Gui(QMainWindow):
         # add the vertical region for channel input, current input, and set current button right of manualShimLayout
         setChannelCurrentShimLayout = QVBoxLayout()
         manualShimLayoutH.addLayout(setChannelCurrentShimLayout)
+        self.shimManualChannelValidator = QIntValidator(0, self.shimTool.shimInstance.numLoops - 1, self)
         self.shimManualChannelEntry = addEntryWithLabel(
             setChannelCurrentShimLayout,
             "Channel Index (Int): ",
-            QIntValidator(0, self.shimTool.shimInstance.numLoops - 1),
+            self.shimManualChannelValidator,
         )
+        self.shimManualCurrentValidator = QDoubleValidator(-2.4, 2.4, 2, self)
         self.shimManualCurrenEntry = addEntryWithLabel(
-            setChannelCurrentShimLayout, "Current (A): ", QDoubleValidator(-2.4, 2.4, 2)
+            setChannelCurrentShimLayout, "Current (A): ", self.shimManualCurrentValidator
         )
         self.shimManualSetCurrentButton = addButtonConnectedToFunction(
             setChannelCurrentShimLayout, "Shim: Set Currents", self.shimSetManualCurrent
@@ -618,16 +647,20 @@ class Gui(QMainWindow):
         leftLayout.addWidget(self.basisView, alignment=Qt.AlignmentFlag.AlignCenter)
         leftLayout.addWidget(self.basicViewLabel)
         self.basisView.setFixedSize(512, 512)  # Set a fixed size for the view
-        self.basisView.setRenderHints(QPainter.RenderHint.Antialiasing | QPainter.RenderHint.SmoothPixmapTransform)
+        self.basisView.setRenderHints(QPainter.RenderHint.SmoothPixmapTransform)
         self.views += [self.basisView]
 
         # add a slider for selecting the basis function
         numbasis = self.shimTool.shimInstance.numLoops + 3
-        self.basisFunctionPack = addLabeledSliderAndEntry(leftLayout, "Basis Index (Int): ", self.updateBasisView)
+        self.basisFunctionPack = addLabeledSliderAndEntry(
+            leftLayout, "Basis Index (Int): ", self.updateBasisView, self.sliceSliderThrottleMs
+        )
         updateSliderEntryLimits(self.basisFunctionPack, 0, numbasis - 1, 0)
 
         # add a label and select for the slice index
-        self.basisSliceIndexPack = addLabeledSliderAndEntry(leftLayout, "Slice Index (Int): ", self.updateBasisView)
+        self.basisSliceIndexPack = addLabeledSliderAndEntry(
+            leftLayout, "Slice Index (Int): ", self.updateBasisView, self.sliceSliderThrottleMs
+        )
         disableWidgetsInList(self.basisSliceIndexPack)
 
     # ---------- Slider Get Functions ----------- #
@@ -742,15 +775,29 @@ class Gui(QMainWindow):
             self.updateShimImageAndStats()
 
     def updateLogOutput(self, log, text):
-        log.append(text)
-
-    def setView(self, qImage: QImage, view: ImageViewer):
-        """Sets the view of the ImageViewer to the given QImage."""
-        pixmap = QPixmap.fromImage(qImage)
+        """Queue up a log line, it gets appended along with the rest of its burst when the flush timer fires."""
+        self.pendingLogLines[log].append(text)
+        if not self.logFlushTimer.isActive():
+            self.logFlushTimer.start()
+
+    def flushLogOutputs(self):
+        """Append all the queued log lines to their log outputs, with one append per output."""
+        for log, lines in self.pendingLogLines.items():
+            if lines:
+                log.append("\n".join(lines))
+                lines.clear()
+
+    def setView(self, qImage: QImage, view: ImageViewer, pixmap: QPixmap = None):
+        """Sets the view of the ImageViewer to the given QImage. Pass in the pixmap if it was already made."""
+        if pixmap is None:
+            pixmap = QPixmap.fromImage(qImage)
         view.viewport().setVisible(True)
+        # the scene only needs to be refit when the size of the image changes
+        refit = view.pixmap_item is None or view.pixmap_item.pixmap().size() != pixmap.size()
         view.set_pixmap(pixmap)
-        view.setSceneRect(view.pixmap_item.boundingRect())  # Adjust scene size to the pixmap's bounding rect
-        view.fitInView(view.pixmap_item, Qt.AspectRatioMode.KeepAspectRatio)  # Fit the view to the item
+        if refit:
+            view.setSceneRect(view.pixmap_item.boundingRect())  # Adjust scene size to the pixmap's bounding rect
+            view.fitInView(view.pixmap_item, Qt.AspectRatioMode.KeepAspectRatio)  # Fit the view to the item
         view.viewport().update()  # Force the viewport to update
 
     def updateAllDisplays(self):
@@ -766,30 +813,62 @@ class Gui(QMainWindow):
         viewDataSlice = self.viewDataSlice[viewIndex]  # this should be a 2d numpy array now
         # if view data is not none, then so should the slice and maxAbs value
         if viewDataSlice is not None:
-            # Extract the slice and normalize it
             scale = self.viewMaxAbs[viewIndex]
-            if np.isnan(viewDataSlice).all():
-                # mainly to get rid of the numpy runtime warning that pops up.
-                normalizedData = np.zeros_like(viewDataSlice)
-            elif viewIndex > 0:
-                # when we are looking at b0maps, the numbers can be negative
-                scale = 2 * scale
-                normalizedData = (viewDataSlice - np.nanmin(viewDataSlice)) / scale * 127 + 127
+            if self.pixmapCacheEdits != self.shimTool.viewDataEdits:
+                # new image data; drop the slices rendered from the old, which may also have freed its addresses
+                self.pixmapCache.clear()
+                self.pixmapCacheEdits = self.shimTool.viewDataEdits
+            # slices are views into the 3d view data, so their address identifies (volume, slice index),
+            # as long as the view data stays the same
+            key = (
+                viewIndex,
+                viewDataSlice.__array_interface__["data"][0],
+                viewDataSlice.shape,
+                viewDataSlice.strides,
+                scale,
+            )
+            cached = self.pixmapCache.get(key)
+            if cached is not None:
+                self.pixmapCache.move_to_end(key)
+                _, qImage, pixmap = cached
             else:
-                normalizedData = (viewDataSlice - np.nanmin(viewDataSlice)) / scale * 255
-            # make the value 127 (correlates to 0 Hz offset) wherever it is outside of mask
-            normalizedData[np.isnan(viewDataSlice)] = 0
-            # specific pyqt6 stuff to convert numpy array to QImage
-            displayData = np.ascontiguousarray(normalizedData).astype(np.uint8)
-            # stack 4 times for R, G, B, and alpha value
-            rgbData = np.stack((displayData,) * 3, axis=-1)
-            height, width, _ = rgbData.shape
-            bytesPerLine = rgbData.strides[0]
-            qImage = QImage(rgbData.data, width, height, bytesPerLine, QImage.Format.Format_RGB888)
+                # Normalize the slice into a reused float32 scratch buffer, then write it once into the rgb buffer
+                scratch = self.displayScratch[viewIndex]
+                if scratch is None or scratch.shape != viewDataSlice.shape:
+                    scratch = np.empty(viewDataSlice.shape, dtype=np.float32)
+                    self.displayScratch[viewIndex] = scratch
+                nanMask = np.isnan(viewDataSlice)
+                if nanMask.all():
+                    # mainly to get rid of the numpy runtime warning that pops up.
+                    scratch.fill(0)
+                else:
+                    if viewIndex > 0:
+                        # when we are looking at b0maps, the numbers can be negative
+                        gain, offset = 127 / (2 * scale), 127
+                    else:
+                        gain, offset = 255 / scale, 0
+                    np.subtract(viewDataSlice, np.nanmin(viewDataSlice), out=scratch)
+                    scratch *= gain
+                    scratch += offset
+                    # make the value 0 wherever it is outside of mask
+                    scratch[nanMask] = 0
+                # specific pyqt6 stuff to convert numpy array to QImage
+                # broadcast into all 3 channels for R, G, B; this is the only new array made per slice
+                rgbData = np.empty(viewDataSlice.shape + (3,), dtype=np.uint8)
+                rgbData[...] = scratch[..., np.newaxis]
+                height, width, _ = rgbData.shape
+                bytesPerLine = rgbData.strides[0]
+                qImage = QImage(rgbData.data, width, height, bytesPerLine, QImage.Format.Format_RGB888)
+                pixmap = QPixmap.fromImage(qImage)
+                # rgbData is kept alongside since the qImage does not own its buffer; the slice isn't kept, as a view
+                # it would keep its whole volume alive
+                self.pixmapCache[key] = (rgbData, qImage, pixmap)
+                if len(self.pixmapCache) > self.pixmapCacheSize:
+                    self.pixmapCache.popitem(last=False)
             # set the actual view that we care about
             self.views[viewIndex].qImage = qImage
             self.views[viewIndex].viewData = viewDataSlice
-            self.setView(qImage, self.views[viewIndex])
+            self.setView(qImage, self.views[viewIndex], pixmap)
 
     def visualizeROI(self):
         """
@@ -1,11 +1,15 @@
 """The Shim Tool Object for orchestrating the shim process."""
 
 
+import multiprocessing
 import os
 import pickle
+import shlex
 import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 from enum import Enum
+from itertools import repeat
 from typing import List
 
 import numpy as np
@@ -39,21 +43,24 @@ class Tool:
         self.guiLog = os.path.join(self.config["rootDir"], self.config["guiLog"])
 
         self.latestStateSavePath = os.path.join(self.config["rootDir"], "toolStates", "shimToolLatestState.pkl")
+        # the numeric arrays of the saved state go to a compressed npz next to the pickle
+        self.latestStateArraysPath = os.path.join(self.config["rootDir"], "toolStates", "shimToolLatestState.npz")
 
-        # Create the log files if they don't exist / empty them if they already have things there
+        # Create the log directories if they don't exist
         for log in [
             self.scannerLog,
             self.shimLog,
             self.guiLog,
             self.latestStateSavePath,
         ]:
-            if not os.path.exists(log):
-                # create the directory and file
-                os.makedirs(os.path.dirname(log), exist_ok=True)
-        for log in [self.scannerLog, self.shimLog, self.guiLog]:
-            with open(log, "w"):  # remake the file empty
-                print(log)
+            os.makedirs(os.path.dirname(log), exist_ok=True)
+        # logs are appended to across restarts, unless resetLogsOnStart is set; the clients handle their own logs
+        if self.config.get("resetLogsOnStart", False):
+            with open(self.guiLog, "w"):  # remake the file empty
                 pass
+        # the gui log monitors open the logs right away, even if no client ever writes to them
+        for log in [self.scannerLog, self.shimLog, self.guiLog]:
+            open(log, "a").close()
 
         # ----------- Clients ----------- #
         # Start the connection from the Shim client.
@@ -76,12 +83,25 @@ class Tool:
         self.maxDeltaTE = 3500  # 2000 us = 2 ms
         self.minDeltaTE = 100  # 2000 us = 2 ms
         self.deltaTE = 3500
+        # the cvs of the b0map fgre scans; the second scan of a pair only adds deltaTE to the te
+        self.fgreCVs = {"act_tr": 6000, "act_te": 1104, "rhrcctrl": 13, "rhimsize": 64}
         self.minGradientCalStrength = 10  # 100 mA
         self.maxGradientCalStrength = 200  # 2 A
         self.gradientCalStrength = 60  # max 300 -- the value at which to record basis map for lin shims
         self.minCalibrationCurrent = 100  # 100 mA
         self.maxCalibrationCurrent = 2000  # 2 A
         self.loopCalCurrent = 1000  # 1 A
+        # number of processes to solve the per slice currents with; 1 solves them serially in this process
+        # opt in through the config: the per slice problems are tiny, so a pool only pays off for many slices
+        self.solverWorkers = self.config.get("solverWorkers", 1)
+        self.solverPool = None  # created on the first solve that needs it
+        # processes to render the result figures with; kept for the life of the tool, since starting them (and
+        # importing matplotlib in each) costs more than rendering a handful of figures
+        self.saveWorkers = max(1, (os.cpu_count() or 2) // 2)
+        self.savePool = None  # created on the first save with enough figures to need it
+        # one long lived thread that queues the scan commands, so the commands of two scans never interleave and
+        # an error while queueing is kept in the returned future instead of being lost with its thread
+        self.scanQueuer = SerialThread()
 
         # tool file directories
         self.gehcExamDataPath = None  # the path to the exam data on the GE Server
@@ -102,15 +122,23 @@ class Tool:
         self.roiMask: np.ndarray = None
         # the intersection of roi, and all nonNan sections of background and basis maps
         self.finalMask: np.ndarray = None
+        # derived from the final mask whenever it changes, so they are not recomputed by every user
+        # flat indices of the voxels in the final mask, grouped by coronal slice, and where each slice's group starts
+        self.finalMaskIndices: np.ndarray = None
+        self.finalMaskSliceStarts: np.ndarray = None
+        self.finalMaskInputs = (None, None, None)  # the background, bases and roi mask the final mask came from
 
         # 3d data arrays
         self.backgroundB0Map: np.ndarray = None  # 3d array of the background b0 map
-        self.rawBasisB0maps: List[np.ndarray] = [
-            None for _ in range(self.shimInstance.numLoops + 3)
-        ]  # 3d arrays of the basis b0 maps with background
         self.basisB0maps: List[np.ndarray] = [
             None for _ in range(self.shimInstance.numLoops + 3)
         ]  # 3d arrays of the basis b0 maps without background
+        # 4d float32 array of the basis b0 maps with background, one 3d map per basis; see rawBasisB0maps
+        self.rawBasisB0mapStack: np.ndarray = None
+        self.basisB0mapStack: np.ndarray = None  # the basisB0maps stacked into one 4d float32 array
+        self.basisB0mapStackBackground: np.ndarray = None  # the background the stack was subtracted from
+        self.basisValidMask: np.ndarray = None  # where the background and all the bases are not nan
+        self.viewDataMask: np.ndarray = None  # the final mask the view data was last cropped with
         self.expectedB0Map: np.ndarray = None  # 3d array of the shimmed b0 map;
         self.shimmedB0Map: np.ndarray = None  # 3d array of the shimmed b0 map;
 
@@ -147,21 +175,20 @@ class Tool:
 
         # ----------- Shim Tool GUI States ----------- #
         # the 3d data for each respective view; they should be cropped with respect to the Final Mask when they are set by the shimTool
-        self.viewData = np.array(
-            [
-                None,  # single set of 3D data, unfilled, for roi view
-                # three sets of 3D data, unfilled, for shim view (background, estimated, actual)
-                np.array([None, None, None], dtype=object),
-                # unfilled 4 dimension numpy array: # of basis views x 3D data for each basis view
-                np.array([None for _ in range(self.shimInstance.numLoops + 3)], dtype=object),
-            ],
-            dtype=object,
-        )
+        # object arrays from np.empty start out filled with None
+        self.viewData = np.empty(3, dtype=object)
+        # [0] single set of 3D data, unfilled, for roi view
+        # three sets of 3D data, unfilled, for shim view (background, estimated, actual)
+        self.viewData[1] = np.empty(3, dtype=object)
+        # unfilled 4 dimension numpy array: # of basis views x 3D data for each basis view
+        self.viewData[2] = np.empty(self.shimInstance.numLoops + 3, dtype=object)
+        # bumped whenever the view data is replaced or written into; the gui drops its rendered slices when it changes
+        self.viewDataEdits = 0
 
     # ----------- Shim Tool Data/State Collection Functions ----------- #
 
     def transferScanData(self):
-        self.log(f"Initiating transfer using rsync.")
+        self.log(f"Initiating transfer using sftp.")
         if self.exsiInstance.examNumber is None:
             self.log("Error: No exam number found in the exsi client instance.")
             return
@@ -174,24 +201,76 @@ class Tool:
                 self.config["hvPassword"],
             )
             self.log(f"obtained exam data path: {self.gehcExamDataPath}")
-        execRsyncCommand(
+        try:
+            transferred = execSFTPTransfer(
+                self.config["host"],
+                self.config["hvPort"],
+                self.config["hvUser"],
+                self.config["hvPassword"],
+                self.gehcExamDataPath,
+                self.localExamRootDir,
+            )
+            self.log(f"Transferred {len(transferred)} new files over sftp.")
+        except Exception as e:
+            self.log(f"Error: sftp transfer failed: {e}")
+            if self.debugging:
+                self.log("Falling back to rsync for the transfer.")
+                self.rsyncScanData()
+
+    def rsyncScanData(self):
+        """Transfer the exam data with rsync, in one session for only the files that aren't complete locally yet."""
+        # list the remote files with their size and mtime in one command over the already open shell,
+        # and diff against what is local
+        remoteFiles = execShellCommand(
+            self.config["host"],
+            self.config["hvPort"],
+            self.config["hvUser"],
+            self.config["hvPassword"],
+            f"cd {shlex.quote(self.gehcExamDataPath)} && find . -type f -printf '%s %T@ %P\\n'",
+        )
+        files = None  # if the listing failed, let rsync compare the whole directory itself
+        if remoteFiles is not None:
+            files = []
+            for line in remoteFiles:
+                parts = line.rstrip("\r\n").split(" ", 2)
+                if len(parts) < 3:
+                    continue
+                size, mtime, path = int(parts[0]), float(parts[1]), parts[2]
+                # a file cut off by an interrupted transfer is shorter and doesn't have the remote mtime yet,
+                # so only the same size with an mtime at least as new as the remote one counts as complete
+                try:
+                    local = os.stat(os.path.join(self.localExamRootDir, path))
+                    if local.st_size == size and int(local.st_mtime) >= int(mtime):
+                        continue
+                except FileNotFoundError:
+                    pass
+                files.append(path)
+            if len(files) == 0:
+                self.log("rsync: all the remote files are already local.")
+                return
+        output = execRsyncCommand(
             self.config["hvPassword"],
             self.config["hvUser"],
             self.config["host"],
-            self.gehcExamDataPath + "/*",
+            self.gehcExamDataPath + "/",
             self.localExamRootDir,
+            files=files,
         )
+        if output.startswith("Error"):
+            self.log(f"rsync {output}")
 
     def getLatestData(self, stride=1, offset=0):
         latestDCMDir = listSubDirs(self.localExamRootDir)[-1]
         res = extractBasicImageData(latestDCMDir, stride, offset)
         self.viewData[0] = res[0]
+        self.viewDataEdits += 1
 
     def getROIBackgound(self):
         self.log("extracting the background mag image")
         res = extractBasicImageData(self.backgroundDCMdir, stride=3, offset=0)
         self.log("done extracting the background mag image")
         self.viewData[0] = res[0]
+        self.viewDataEdits += 1
 
     def saveState(self):
         """Save all the state attributes so that they can be reloaded later.
@@ -204,7 +283,6 @@ class Tool:
             "autoPrescanDone",
             "backgroundB0Map",
             "rawBasisB0maps",
-            "basisB0maps",
             "expectedB0Map",
             "viewData",
             "shimmedB0Map",
@@ -224,8 +302,14 @@ class Tool:
         # Create a dictionary to hold your attributes
         attr_dict = {name: getattr(self, name) for name in attr_names if hasattr(self, name)}
 
+        # the b0 maps and masks are smooth / sparse, so they compress well; only the rest needs to be pickled
+        # the basisB0maps aren't saved, the stack is rebuilt from the background and raw basis maps on load
+        arrays = {
+            name: value for name, value in attr_dict.items() if isinstance(value, np.ndarray) and value.dtype != object
+        }
+        np.savez_compressed(self.latestStateArraysPath, **arrays)
         with open(self.latestStateSavePath, "wb") as f:
-            pickle.dump(attr_dict, f)
+            pickle.dump({name: value for name, value in attr_dict.items() if name not in arrays}, f)
 
         self.log("Saved the state of the tool.")
 
@@ -247,12 +331,22 @@ class Tool:
         with open(self.latestStateSavePath, "rb") as f:
             try:
                 attr_dict = pickle.load(f)
+                # older saves also have the background subtracted basisB0maps; those are rebuilt from the raw maps
+                attr_dict.pop("basisB0maps", None)
                 for name, value in attr_dict.items():
                     setattr(self, name, value)
             except EOFError as e:
                 self.log(f"ERROR: Failed to load state: {e}")
                 return
 
+        if os.path.exists(self.latestStateArraysPath):
+            with np.load(self.latestStateArraysPath, allow_pickle=False) as arrays:
+                for name in arrays.files:
+                    setattr(self, name, arrays[name])
+        self.updateFinalMaskCache()
+        self.updateBasisB0mapStack()
+        self.viewDataEdits += 1
+
     def getSolutions(self, sliceIdx=None):
         if self.shimMode == ShimMode.SLICE and sliceIdx is not None:
             return self.solutionsPerSlice[sliceIdx]
@@ -281,9 +375,28 @@ class Tool:
 
     def computeMask(self):
         """compute the mask for the shim images"""
-        self.finalMask = createMask(self.backgroundB0Map, self.basisB0maps, self.ROI.getROIMask())
+        inputs = (self.backgroundB0Map, self.basisB0maps, self.ROI.getROIMask())
+        # the inputs are replaced, not modified in place, when they change; so the same objects give the same mask
+        if self.finalMask is not None and all(a is b for a, b in zip(inputs, self.finalMaskInputs)):
+            return
+        # the basis stack already found where the background and bases are valid, if it was built on this background
+        valid = self.basisValidMask if self.basisB0mapStackBackground is self.backgroundB0Map else None
+        self.finalMask = createMask(*inputs, valid=valid)
+        self.finalMaskInputs = inputs
+        self.updateFinalMaskCache()
         self.log(f"Computed Mask from background, basis and ROI.")
 
+    def updateFinalMaskCache(self):
+        """Recompute the flat indices of the final mask; needs to run whenever the final mask is set"""
+        if self.finalMask is None:
+            self.finalMaskIndices = None
+            self.finalMaskSliceStarts = None
+        else:
+            # walk the mask slice first, so the voxels of every slice come out as one contiguous run
+            sliceIdx, a, b = np.nonzero(np.moveaxis(self.finalMask, 1, 0))
+            self.finalMaskIndices = np.ravel_multi_index((a, sliceIdx, b), self.finalMask.shape)
+            self.finalMaskSliceStarts = np.concatenate(([0], np.cumsum(self.finalMask.sum(axis=(0, 2)))))
+
     def cropViewDataToFinalMask(self):
         """
         Update the viewable data with the mask applied. i.e. crop it to the final ROI.
@@ -294,18 +407,32 @@ class Tool:
         # send the masked versions of the data to the GUI
         for i, map in enumerate(maps):
             if map is not None:
-                toViewer = np.copy(map)
-                toViewer[~self.finalMask] = np.nan
-                self.viewData[1][i] = toViewer
+                self.viewData[1][i] = np.where(self.finalMask, map, np.nan)
 
-        for i, basis in enumerate(self.basisB0maps):
-            if basis is not None:
-                toViewer = np.copy(basis)
-                toViewer[~self.finalMask] = np.nan
-                self.viewData[2][i] = toViewer
+        if self.basisB0mapStack is not None:
+            # mask every basis in one pass over the stack, then hand out the per basis views
+            maskedBases = np.where(self.finalMask[np.newaxis], self.basisB0mapStack, np.nan)
+            for i in range(maskedBases.shape[0]):
+                self.viewData[2][i] = maskedBases[i]
 
+        self.viewDataMask = self.finalMask
+        self.viewDataEdits += 1
         self.log(f"Masked obtained data and 'sent to GUI.'")
 
+    def cropShimmedViewSliceToFinalMask(self, idx):
+        """
+        Update only slice idx of the shimmed view data, for when just that slice of the shimmed map was obtained.
+        Falls back to cropping everything if the view data wasn't cropped with the current final mask yet.
+        """
+        shimmedView = self.viewData[1][2]
+        if shimmedView is None or self.viewDataMask is not self.finalMask:
+            self.cropViewDataToFinalMask()
+            return
+        # write just the slice into the existing view, instead of copying the whole volume for it
+        np.copyto(shimmedView[:, idx, :], np.where(self.finalMask[:, idx, :], self.shimmedB0Map[:, idx, :], np.nan))
+        self.viewDataEdits += 1
+        self.log(f"Masked the shimmed slice {idx} and 'sent to GUI.'")
+
     def setShimMode(self, mode):
         """
         Set the shim mode for the scanner, either Volume or Slice-Wise.
@@ -315,7 +442,7 @@ class Tool:
         self.resetPrincipleSols()
 
     def resetPrincipleSols(self):
-        self.principleSols = np.array([0.0 for _ in range(4 + self.shimInstance.numLoops)], dtype=np.float64)
+        self.principleSols = np.zeros(4 + self.shimInstance.numLoops, dtype=np.float64)
         if self.exsiInstance.ogCenterFrequency is not None:
             self.principleSols[0] = self.exsiInstance.ogCenterFrequency
         if self.exsiInstance.ogLinearGradients is not None:
@@ -338,13 +465,17 @@ class Tool:
 
     def resetActualResults(self):
         self.shimmedB0Map = None
+        self.viewData[1][2] = None  # otherwise the next shimmed slice would be written into the old shimmed view
+        self.viewDataEdits += 1
         self.resetStats(2)
 
     def resetShimSolsAndActual(self):
         self.expectedB0Map = None
+        self.shimmedB0Map = None
+        self.viewData[1][2] = None  # otherwise the next shimmed slice would be written into the old shimmed view
+        self.viewDataEdits += 1
         self.resetSolutions()
-        self.resetStats(1)
-        self.resetActualResults()
+        self.resetStats(1, 3)  # expected and actual stats in one go
 
     def overwriteBackground(self, sliceIdx=None):
         """
@@ -353,8 +484,9 @@ class Tool:
         The solution will also be saved as a "principle solution" as if a prescan was done and it landed at these solved values
         """
         if self.solutionValuesToApplyPerSlice is not None and sliceIdx is not None:
-            self.principleSols = self.principleSols + self.solutionValuesToApplyPerSlice[sliceIdx]
-        self.backgroundB0Map = self.shimmedB0Map
+            self.principleSols += self.solutionValuesToApplyPerSlice[sliceIdx]
+        # hand the shimmed map over, so the background is never the same array that shimmed slices get written into
+        self.backgroundB0Map, self.shimmedB0Map = self.shimmedB0Map, None
         self.resetShimSolsAndActual()
         self.recomputeCurrentsAndView()
 
@@ -369,7 +501,100 @@ class Tool:
 
     def computeBasisB0maps(self):
         # assumes that you have just gotten background by queueBasisPairScan
-        self.rawBasisB0maps = compute_b0maps(self.shimInstance.numLoops + 3, self.localExamRootDir)
+        rawMaps = compute_b0maps(self.shimInstance.numLoops + 3, self.localExamRootDir)
+        self.rawBasisB0maps = np.stack(rawMaps, axis=0)
+        self.updateBasisB0mapStack()
+
+    def resetBasisB0maps(self):
+        self.rawBasisB0mapStack = None
+        self.basisB0mapStack = None
+        self.basisB0mapStackBackground = None
+        self.basisB0maps = [None for _ in range(self.shimInstance.numLoops + 3)]
+        self.basisValidMask = None
+
+    @property
+    def rawBasisB0maps(self) -> np.ndarray:
+        """The basis maps with background, as scanned; the stack is subtracted from them again for every background"""
+        return self.rawBasisB0mapStack
+
+    @rawBasisB0maps.setter
+    def rawBasisB0maps(self, value: np.ndarray):
+        self.resetBasisB0maps()
+        # older saves have a list of the maps, which is all None before the calibration scans
+        if isinstance(value, list) and (len(value) == 0 or any(m is None for m in value)):
+            value = None
+        if value is not None:
+            self.rawBasisB0mapStack = np.asarray(value, dtype=np.float32)
+
+    def updateBasisB0mapStack(self):
+        """
+        Subtract the current background from the raw basis maps into the stacked basis array.
+        Nothing is done when the stack was already built from this background, or there is no background yet.
+        """
+        if self.rawBasisB0mapStack is None or self.backgroundB0Map is None:
+            return
+        if self.basisB0mapStackBackground is self.backgroundB0Map and self.basisB0mapStack is not None:
+            return
+        # always from the raw maps, never by shifting the old stack; a nan in any background would stick for good
+        # the stack of the last background is written over, as nothing outside the tool holds on to it
+        # find where the background and bases are valid in the same pass, so computeMask doesn't rescan them
+        self.basisValidMask = np.ones(self.backgroundB0Map.shape, dtype=bool)
+        self.basisB0mapStack = subtractBackground(
+            self.backgroundB0Map, self.rawBasisB0mapStack, self.basisValidMask, out=self.basisB0mapStack
+        )
+        self.basisB0maps = list(self.basisB0mapStack)  # views into the stack, not copies
+        self.basisB0mapStackBackground = self.backgroundB0Map
+
+    def solveProblems(self, problems):
+        """
+        Solve a list of (AᵀA, Aᵀy, numVoxels) problems for their currents, in order.
+        Uses the solver process pool when there are multiple problems and solverWorkers allows it.
+        """
+        if self.solverWorkers is None or self.solverWorkers <= 1 or len(problems) < 2:
+            return [
+                solveNormalEquations(*problem, self.gradientCalStrength, self.loopCalCurrent, debug=self.debugging)
+                for problem in problems
+            ]
+
+        if self.solverPool is None:
+            # spawn rather than fork, so the workers don't inherit the gui and client threads
+            self.solverPool = ProcessPoolExecutor(
+                max_workers=self.solverWorkers, mp_context=multiprocessing.get_context("spawn")
+            )
+        atas, atys, counts = zip(*problems)
+        return list(
+            self.solverPool.map(
+                solveNormalEquations,
+                atas,
+                atys,
+                counts,
+                repeat(self.gradientCalStrength),
+                repeat(self.loopCalCurrent),
+                repeat(self.debugging),
+                chunksize=max(1, len(problems) // (4 * self.solverWorkers)),
+            )
+        )
+
+    def shutdownPools(self):
+        """Stop the solver and figure processes, if they were started, and the scan queueing thread."""
+        if self.solverPool is not None:
+            self.solverPool.shutdown(cancel_futures=True)
+            self.solverPool = None
+        if self.savePool is not None:
+            self.savePool.shutdown(cancel_futures=True)
+            self.savePool = None
+        self.scanQueuer.shutdown()
+
+    def handleQueueingFailure(self, queued):
+        """After scans didn't complete, log why queueing them failed, or give up on the queueing if it is stuck."""
+        if not queued.done():
+            # still blocked, e.g. on the task keys of a protocol that failed to load; leave that thread behind so the
+            # next scans aren't queued behind it
+            self.log("Error: queueing the scans didn't finish, starting a new queueing thread")
+            self.scanQueuer.shutdown()
+            self.scanQueuer = SerialThread()
+        elif queued.exception() is not None:
+            self.log(f"Error: queueing the scans failed: {queued.exception()}")
 
     def computeShimCurrents(self):
         """
@@ -377,48 +602,40 @@ class Tool:
         Save the generated expected B0 map to the expectedB0map array
         """
         # run whenever both backgroundB0Map and basisB0maps are computed or if one new one is obtained
-        self.basisB0maps = subtractBackground(self.backgroundB0Map, self.rawBasisB0maps)
+        self.updateBasisB0mapStack()
         self.computeMask()
 
+        # Precompute the normal equations of every slice once, the per slice and volume problems are sums of them
+        sliceAtA, sliceAtY, sliceCounts = sliceNormalEquations(
+            self.backgroundB0Map, self.basisB0mapStack, self.finalMaskIndices, self.finalMaskSliceStarts
+        )
+
         # Compute the Currents Per Slice.
-        self.solutionsPerSlice = [None for _ in range(self.backgroundB0Map.shape[1])]
-        for i in range(self.backgroundB0Map.shape[1]):
-            # Get mask containing the slice in question
-            centerMask = maskOneSlice(self.finalMask, i)
-            centerMaskIsEmpty = (~centerMask).all()
-
-            # Want to include slice in front and behind in the mask when solving currents for Grad smoothness
-            neighborsMask = centerMask
-            leftNeighborIsEmpty = True
-            rightNeighborIsEmpty = True
-            if i > 0:
-                leftNeighbor = maskOneSlice(self.finalMask, i - 1)
-                leftNeighborIsEmpty = (~leftNeighbor).all()
-                neighborsMask = np.logical_or(neighborsMask, leftNeighbor)
-            if i < self.backgroundB0Map.shape[1] - 1:
-                rightNeighbor = maskOneSlice(self.finalMask, i - 1)
-                rightNeighborIsEmpty = (~rightNeighbor).all()
-                neighborsMask = np.logical_or(neighborsMask, rightNeighbor)
-
-            if centerMaskIsEmpty and (leftNeighborIsEmpty or rightNeighborIsEmpty):
-                # self.log(f"Slice {i} and 1 or more neighbors are empty. Skipping.")
-                continue
-
-            # Solve the solution currents for the slice
-            self.solutionsPerSlice[i] = solveCurrents(
-                self.backgroundB0Map,
-                self.basisB0maps,
-                neighborsMask,
-                self.gradientCalStrength,
-                self.loopCalCurrent,
-                debug=self.debugging,
-            )
+        numSlices = self.backgroundB0Map.shape[1]
+        self.solutionsPerSlice = [None for _ in range(numSlices)]
+        # Want to include slice in front and behind in the mask when solving currents for Grad smoothness
+        # so every slice's problem is the sum of its own and its neighbors' normal equations
+        windowAtA, windowAtY, windowCounts = np.copy(sliceAtA), np.copy(sliceAtY), np.copy(sliceCounts)
+        for window, sliceSums in ((windowAtA, sliceAtA), (windowAtY, sliceAtY), (windowCounts, sliceCounts)):
+            window[1:] += sliceSums[:-1]
+            window[:-1] += sliceSums[1:]
+
+        # skip slices that are empty along with 1 or more of their neighbors
+        empty = sliceCounts == 0
+        leftNeighborIsEmpty = np.concatenate(([True], empty[:-1]))
+        rightNeighborIsEmpty = np.concatenate((empty[1:], [True]))
+        sliceIndices = np.flatnonzero(~(empty & (leftNeighborIsEmpty | rightNeighborIsEmpty)))
+        sliceProblems = [(windowAtA[i], windowAtY[i], windowCounts[i]) for i in sliceIndices]
+
+        # Solve the solution currents for the slices; they are independent so they can run in parallel
+        for i, solution in zip(sliceIndices, self.solveProblems(sliceProblems)):
+            self.solutionsPerSlice[i] = solution
 
         # Compute the currents for the selected ROI
-        self.solutionsVolume = solveCurrents(
-            self.backgroundB0Map,
-            self.basisB0maps,
-            self.finalMask,
+        self.solutionsVolume = solveNormalEquations(
+            sliceAtA.sum(axis=0),
+            sliceAtY.sum(axis=0),
+            sliceCounts.sum(),
             self.gradientCalStrength,
             self.loopCalCurrent,
             debug=self.debugging,
@@ -428,28 +645,20 @@ class Tool:
 
         # if not all currents are none
         if not all([c is None for c in self.solutionsPerSlice]):
-            self.expectedB0Map = self.backgroundB0Map.copy()
             if self.shimMode == ShimMode.SLICE:
-                for i in range(self.backgroundB0Map.shape[1]):
-                    if self.solutionsPerSlice[i] is not None:
-                        self.expectedB0Map[:, i, :] += self.solutionsPerSlice[i][0] * np.ones(
-                            self.backgroundB0Map[:, 0, :].shape
-                        )
-                        numIter = self.shimInstance.numLoops + 3
-                        for j in range(numIter):
-                            self.expectedB0Map[:, i, :] += (
-                                self.solutionsPerSlice[i][j + 1] * self.basisB0maps[j][:, i, :]
-                            )
-                    else:
-                        self.expectedB0Map[:, i, :] = np.nan
+                # one row of solutions per slice; slices without a solution are nan so their estimate is nan too
+                nanSol = np.full(self.basisB0mapStack.shape[0] + 1, np.nan)
+                sols = np.array([nanSol if sol is None else sol for sol in self.solutionsPerSlice])
+                self.expectedB0Map = assembleExpectedB0Map(self.backgroundB0Map, self.basisB0mapStack, sols)
             else:  # VOLUME
                 if self.solutionsVolume is not None:
-                    self.expectedB0Map += self.solutionsVolume[0] * np.ones(self.backgroundB0Map.shape)
-                    numIter = self.shimInstance.numLoops + 3
-                    for j in range(numIter):
-                        self.expectedB0Map += self.solutionsVolume[j + 1] * self.basisB0maps[j]
+                    # in the maps' precision, so the expected map doesn't get promoted back to float64
+                    sol = self.solutionsVolume.astype(self.basisB0mapStack.dtype)
+                    self.expectedB0Map = (
+                        self.backgroundB0Map + sol[0] + np.tensordot(sol[1:], self.basisB0mapStack, axes=1)
+                    )
                 else:
-                    self.expectedB0Map = np.nan
+                    self.expectedB0Map = np.full_like(self.backgroundB0Map, np.nan)
 
             self.cropViewDataToFinalMask()
             self.log("Computed solutions and created new estimate shim maps")
@@ -461,14 +670,20 @@ class Tool:
     def computeShimmedB0Map(self, idx):
         """Compute the just obtained b0map of the shimmed background, for the specific slice selected"""
         b0maps = compute_b0maps(1, self.localExamRootDir)
-        if self.shimmedB0Map is None:
+        newMap = self.shimmedB0Map is None
+        if newMap:
             self.shimmedB0Map = np.full_like(b0maps[0], np.nan)
         if self.shimMode == ShimMode.SLICE:
             self.shimmedB0Map[:, idx, :] = b0maps[0][:, idx, :]
+            if newMap:
+                # every other slice of a shimmed view from before would be stale, so crop the whole new map
+                self.cropViewDataToFinalMask()
+            else:
+                self.cropShimmedViewSliceToFinalMask(idx)
         else: # VOLUME
             self.log(f"saved volume shimmed b0map")
             self.shimmedB0Map = b0maps[0]
-        self.cropViewDataToFinalMask()
+            self.cropViewDataToFinalMask()
 
     def evaluateShimImages(self):
         """evaluate the shim images (with the final mask applied) and store the stats in the stats array."""
@@ -479,15 +694,17 @@ class Tool:
                 self.shimStatsPerSlice[i] = [None for _ in range(self.backgroundB0Map.shape[1])]
                 self.shimStatStrsVolume[i] = None
                 self.shimStatsVolume[i] = None
+                # gather the masked voxels once; every slice's voxels are then a contiguous view of them
+                values = np.take(map, self.finalMaskIndices)
                 for j in range(self.backgroundB0Map.shape[1]):
-                    mask = maskOneSlice(self.finalMask, j)
-                    if not np.isnan(map[mask]).all():
-                        statsstr, stats = evaluate(map[mask], self.debugging)
+                    sliceValues = values[self.finalMaskSliceStarts[j] : self.finalMaskSliceStarts[j + 1]]
+                    if not np.isnan(sliceValues).all():
+                        statsstr, stats = evaluate(sliceValues, self.debugging)
                         self.shimStatStrsPerSlice[i][j] = statsstr
                         self.shimStatsPerSlice[i][j] = stats
                 self.log(f"finished setting the per slice stats for map {i}")
 
-                statsstr, stats = evaluate(map[self.finalMask], self.debugging)
+                statsstr, stats = evaluate(values, self.debugging)
                 self.shimStatStrsVolume[i] = statsstr
                 self.shimStatsVolume[i] = stats
                 self.log(f"finished setting the volume stats for map {i}")
@@ -500,74 +717,69 @@ class Tool:
     #     Helpful to evaluate if the solutions are actually what is being applied.
     #     """
     #     b0maps = compute_b0maps(self.shimInstance.numLoops + 4, self.localExamRootDir)
+    #     # save the b0maps to the eval folder
+    #     evalDir = os.path.join(
+    #         self.config["rootDir"],
+    #         "results",
+    #         self.exsiInstance.examNumber,
+    #         "eval",
+    #         f"slice_{sliceIdx}",
+    #     )
+    #     os.makedirs(evalDir, exist_ok=True)
+    #     arrays = {}
+    #     numCols = 4
+    #     numRows = -(-len(b0maps) // numCols)  # ceil
+    #     fig, axes = plt.subplots(numRows, numCols, figsize=(4 * numCols, 3 * numRows), squeeze=False)
     #     for i in range(len(b0maps)):
-    #         # save the b0map to the eval folder
-    #         evalDir = os.path.join(
-    #             self.config["rootDir"],
-    #             "results",
-    #             self.exsiInstance.examNumber,
-    #             "eval",
-    #             f"slice_{sliceIdx}",
-    #         )
-    #         if not os.path.exists(evalDir):
-    #             os.makedirs(evalDir)
-    #         np.save(os.path.join(evalDir, f"b0map{i}.npy"), b0maps[i][:, sliceIdx, :])
     #         # compute the difference from the expected b0map
     #         expected = np.copy(self.backgroundB0Map[:, sliceIdx, :])
     #         if i == 0:
-    #             expected += self.solutionsPerSlice[sliceIdx][i] * np.ones(expected.shape)
+    #             expected += self.solutionsPerSlice[sliceIdx][i]
     #         else:
     #             expected += self.solutionsPerSlice[sliceIdx][i] * self.basisB0maps[i - 1][:, sliceIdx, :]
-
-    #         np.save(os.path.join(evalDir, f"expected{i}.npy"), expected)
+    #         arrays[f"b0map{i}"] = b0maps[i][:, sliceIdx, :]
+    #         arrays[f"expected{i}"] = expected
 
     #         difference = b0maps[i][:, sliceIdx, :] - expected
-    #         fig, ax = plt.subplots(figsize=(8, 6))
+    #         ax = axes[i // numCols, i % numCols]
     #         im = ax.imshow(difference, cmap="jet", vmin=-100, vmax=100)
-    #         cbar = plt.colorbar(im)
-
-    #         plt.title(f"difference basis{i}, slice{sliceIdx}", size=10)
-    #         plt.axis("off")
-
-    #         fig.savefig(
-    #             os.path.join(evalDir, f"difference{i}.png"),
-    #             bbox_inches="tight",
-    #             transparent=False,
-    #         )
-    #         plt.close(fig)
+    #         fig.colorbar(im, ax=ax)
+    #         ax.set_title(f"difference basis{i}, slice{sliceIdx}", size=10)
+    #     for ax in axes.flat:
+    #         ax.axis("off")
+
+    #     np.savez(os.path.join(evalDir, "all.npz"), **arrays)
+    #     fig.savefig(
+    #         os.path.join(evalDir, "differences.png"),
+    #         bbox_inches="tight",
+    #         transparent=False,
+    #     )
+    #     plt.close(fig)
 
     def setSolutionsToApply(self):
         """
         From the Solutions, set the actual values that will be applied to the shim system.
         These differ because the solutions are in terms of multiples of basis maps, not necessarily the values that get applied.
         """
+        # cf does not change, lingrads are scaled by the gradient cal strength, and loops by the loop cal current
+        numSols = 4 + self.shimInstance.numLoops
+        scale = np.ones(numSols, dtype=np.float64)
+        scale[1:4] = self.gradientCalStrength
+        scale[4:] = self.loopCalCurrent
+
         # Setting Solutions for the each slice
-        # cf does not change.
         if self.solutionsPerSlice is not None:
-            self.solutionValuesToApplyPerSlice = [None for i in range(len(self.solutionsPerSlice))]
-            for i in range(len(self.solutionsPerSlice)):
-                if self.solutionsPerSlice[i] is not None:
-                    self.solutionValuesToApplyPerSlice[i] = np.copy(self.solutionsPerSlice[i])
-                    for j in range(1, 4):
-                        # update the lingrad values
-                        self.solutionValuesToApplyPerSlice[i][j] = (
-                            self.solutionsPerSlice[i][j] * self.gradientCalStrength
-                        )
-                    for j in range(4, len(self.solutionsPerSlice[i])):
-                        # update the current values
-                        self.solutionValuesToApplyPerSlice[i][j] = (
-                            self.solutionsPerSlice[i][j] * self.loopCalCurrent
-                        )
+            nanSol = np.full(numSols, np.nan)
+            solutions = np.array([nanSol if sol is None else sol for sol in self.solutionsPerSlice])
+            # one multiply for every slice, then the unsolved slices go back to None
+            toApply = solutions * scale[np.newaxis, :]
+            self.solutionValuesToApplyPerSlice = [
+                None if sol is None else row for sol, row in zip(self.solutionsPerSlice, toApply)
+            ]
 
         # for the Volume Solution to apply
         if self.solutionsVolume is not None:
-            self.solutionValuesToApplyVolume = np.copy(self.solutionsVolume)
-            for j in range(1, 4):
-                # update the lingrad values
-                self.solutionValuesToApplyVolume[j] = self.solutionsVolume[j] * self.gradientCalStrength
-            for j in range(4, len(self.solutionsVolume)):
-                # update the current values
-                self.solutionValuesToApplyVolume[j] = self.solutionsVolume[j] * self.loopCalCurrent
+            self.solutionValuesToApplyVolume = self.solutionsVolume * scale
 
     # ----------- SHIM Sub Operations and macro function helpers ----------- #
 
@@ -579,56 +791,51 @@ class Tool:
 
     def setLinGradients(self, linGrad=[0.0, 0.0, 0.0]):
         """Set the new gradient as offset from the prescan set ones"""
-        # if lingrad is a list of 3 ints, make them numpy array
-        if type(linGrad) == list:
-            linGrad = np.array(linGrad, dtype=np.float64)
-
-        linGrad += self.principleSols[1:4]
-
-        linGrad = np.round(linGrad).astype(int)
+        # a new array, so the solution values passed in aren't offset in place
+        linGrad = np.round(np.asarray(linGrad, dtype=np.float64) + self.principleSols[1:4]).astype(int)
         self.exsiInstance.sendSetShimValues(*linGrad)
 
     def sendSyncedLoopSolution(self, channel: int, sliceIdx: int = None, ZeroOthers=False, calibration=False):
         """Send a shim loop set current command, but via the ExSI client
-        to ensure that the commands are synced with other exsi commands."""
-        principleOffset = self.principleSols[channel]
-        current = solutionToApply + principleOffset
-
-        solution = self.getSolutions(sliceIdx)[channel + 4]
-        solutionToApply = self.getSolutionsToApply(sliceIdx)[channel + 4]
-
+        to ensure that the commands are synced with other exsi commands.
+        With ZeroOthers, all the other loops are set back to their principle values in the same command."""
         if calibration:
             solutionToApply = self.loopCalCurrent
+        else:
+            solutionToApply = self.getSolutionsToApply(sliceIdx)[channel + 4]
+        # the loop principles come after the cf and the 3 linear gradients
+        principleOffsets = self.principleSols[4:]
+        current = solutionToApply + principleOffsets[channel]
         self.log(
-            f"Queueing loop {channel} to {current:.3f}: solution={solution:.3f}, solToAply={solutionToApply:.3f}, principle={principleOffset:.3f}"
+            f"Queueing loop {channel} to {current:.3f}: solToAply={solutionToApply:.3f}, principle={principleOffsets[channel]:.3f}"
         )
-        self.exsiInstance.send(f"X {channel} {current}")
 
-        if ZeroOthers:
-            # if this is some calibration scan, we want to zero all the other loops (or set them to their principle values)
-            for i in range(self.shimInstance.numLoops):
-                if i != channel:
-                    self.sendSyncedLoopSolution(i, sliceIdx, ZeroOthers=False, calibration=calibration)
+        if not ZeroOthers:
+            self.exsiInstance.send(f"X {channel} {current:.3f}")
+            return
+
+        # if this is some calibration scan, we want to zero all the other loops (or set them to their principle values)
+        currents = np.copy(principleOffsets)
+        currents[channel] = current
+        self.sendSyncedLoopCurrents(currents)
+
+    def sendSyncedLoopCurrents(self, currents):
+        """Queue the currents of all the loops, in channel order, as one X_BATCH command via the ExSI client."""
+        self.exsiInstance.send("X_BATCH " + " ".join(f"{i} {c:.3f}" for i, c in enumerate(currents)))
 
     def queueTwoFgreSequences(self):
         """
         once the b0map sequence is loaded, subroutines are iterated along with cvs to obtain basis maps.
         linGrad should be a list of 3 floats if it is not None
         """
-        cvs = {"act_tr": 6000, "act_te": 1104, "rhrcctrl": 13, "rhimsize": 64}
+        pairCVs = [self.fgreCVs, {**self.fgreCVs, "act_te": self.fgreCVs["act_te"] + self.deltaTE}]
         for i in range(2):
             self.exsiInstance.sendSelTask()
             self.exsiInstance.sendSetScanPlaneOrientation()
             self.exsiInstance.sendSetCenterPosition()
             self.exsiInstance.sendActTask()
-            for cv in cvs.keys():
-                if cv == "act_te":
-                    if i == 0:
-                        self.exsiInstance.sendSetCV(cv, cvs[cv])
-                    else:
-                        self.exsiInstance.sendSetCV(cv, cvs[cv] + self.deltaTE)
-                else:
-                    self.exsiInstance.sendSetCV(cv, cvs[cv])
+            for cv, value in pairCVs[i].items():
+                self.exsiInstance.sendSetCV(cv, value)
             self.exsiInstance.sendPatientTable()
             if not self.autoPrescanDone:
                 self.exsiInstance.prescanDone.clear()
@@ -656,26 +863,45 @@ class Tool:
         self.exsiInstance.sendLoadProtocol("ConformalShimCalibration3")
         self.queueTwoFgreSequences()
 
-    def countScansCompleted(self, n):
-        """should be 2 for every basis pair scan"""
+    def countScansCompleted(self, n, start=None):
+        """
+        should be 2 for every basis pair scan
+        start is the exsi images_ready_count from before the scans were queued; scans that already finished by the
+        time this is called are then still counted. If not given, only scans that finish from now on count.
+        """
+        if start is None:
+            start = self.exsiInstance.images_ready_count
         for i in range(n):
-            self.log(f"Checking for failure on last run; On scan {i+1} / {n}")
+            self.log(f"Waiting for scan to complete, On scan {i+1} / {n}")
+            # wakes up as soon as the images are ready or a command fails, there is no polling
+            done = self.exsiInstance.waitForImagesReady(start + i + 1, timeout=90)
             if not self.exsiInstance.no_failures.is_set():
                 self.log("Error: scan failed")
                 self.exsiInstance.no_failures.set()
                 return False
-            self.log(f"No Fail. Waiting for scan to complete, On scan {i+1} / {n}")
-            if not self.exsiInstance.images_ready_event.wait(timeout=90):
+            if not done:
                 self.log(f"Error: scan {i+1} / {n} didn't complete within 90 seconds bruh")
                 return False
-            else:
-                self.exsiInstance.images_ready_event.clear()
                 # TODO probably should raise some sorta error here...
         self.log(f"Done. {n} scans completed!")
         # after scans get completed, go ahead and get the latest scan data over on this machine...
         self.transferScanData()
         return True
 
+    def countBasisPairsCompleted(self, n, start=None):
+        """
+        Wait for n b0map pairs, counting from the exsi images_ready_count start, as for countScansCompleted.
+        The data is transferred after every pair, so the transfers overlap with the scanner working on the next pairs
+        and only the last pair is left to pull over once the scanner is done.
+        """
+        if start is None:
+            start = self.exsiInstance.images_ready_count
+        for i in range(n):
+            self.log(f"Waiting on b0map pair {i+1} / {n}")
+            if not self.countScansCompleted(2, start + 2 * i):
+                return False
+        return True
+
     def requireShimConnection(func):
         """Decorator to check if the EXSI client is connected before running a function."""
 
@@ -732,10 +958,10 @@ class Tool:
             self.exsiInstance.sendSetCenterPosition("axial")
             self.exsiInstance.sendActTask()
             self.exsiInstance.sendPatientTable()
+            start = self.exsiInstance.images_ready_count
             self.exsiInstance.sendScan()
-            if self.exsiInstance.images_ready_event.wait(timeout=120):
+            if self.exsiInstance.waitForImagesReady(start + 1, timeout=120):
                 self.assetCalibrationDone = True
-                self.exsiInstance.images_ready_event.clear()
                 self.transferScanData()
                 self.getLatestData(stride=1)
         if trigger is not None:
@@ -751,11 +977,11 @@ class Tool:
             self.exsiInstance.sendSetCenterPosition()
             self.exsiInstance.sendActTask()
             self.exsiInstance.sendPatientTable()
+            start = self.exsiInstance.images_ready_count
             self.exsiInstance.sendScan()
-            if not self.exsiInstance.images_ready_event.wait(timeout=120):
+            if not self.exsiInstance.waitForImagesReady(start + 1, timeout=120):
                 self.log(f"scan didn't complete")
             else:
-                self.exsiInstance.images_ready_event.clear()
                 self.transferScanData()
                 self.getLatestData(stride=1)
         if trigger is not None:
@@ -803,11 +1029,11 @@ class Tool:
             self.shimInstance.shimZero()
             obtainPrinciples = True
 
-        # need to kick this off in a new thread because it waits for the prescan to be completed if it is doing a prescan
-        kickoff_thread(self.queueB0MapPairScan)
+        # queued on another thread because it waits for the prescan to be completed if it is doing a prescan
+        start = self.exsiInstance.images_ready_count
+        queued = self.scanQueuer.submit(self.queueB0MapPairScan)
 
-        self.exsiInstance.images_ready_event.clear()
-        if self.countScansCompleted(2):
+        if self.countScansCompleted(2, start):
             self.transferScanData()
 
             if self.obtainedBackground():
@@ -825,6 +1051,7 @@ class Tool:
 
         else:
             self.log("Error: Scans didn't complete")
+            self.handleQueueingFailure(queued)
             self.exsiInstance.images_ready_event.clear()
             self.exsiInstance.ready_event.clear()
         if trigger is not None:
@@ -851,13 +1078,12 @@ class Tool:
                 self.setLinGradients()  # set linear gradients down to zero
                 self.queueTwoFgreSequences()
 
-        kickoff_thread(queueAll)
+        start = self.exsiInstance.images_ready_count
+        queued = self.scanQueuer.submit(queueAll)
 
         self.shimInstance.shimZero()  # NOTE: Hopefully this zeros quicker that the scans get set up...
-        self.rawBasisB0maps = None
-        self.exsiInstance.images_ready_event.clear()
-        num_scans = (self.shimInstance.numLoops + 3) * 2
-        if self.countScansCompleted(num_scans):
+        self.resetBasisB0maps()
+        if self.countBasisPairsCompleted(self.shimInstance.numLoops + 3, start):
             self.log("DEBUG: just finished all the calibration scans")
             self.computeBasisB0maps()
             # if this is a new background scan and basis maps were obtained, then compute the shim currents
@@ -868,6 +1094,7 @@ class Tool:
             self.evaluateShimImages()
         else:
             self.log("Error: Scans didn't complete")
+            self.handleQueueingFailure(queued)
             self.exsiInstance.images_ready_event.clear()
             self.exsiInstance.ready_event.clear()
         if trigger is not None:
@@ -877,17 +1104,23 @@ class Tool:
     def setAllShimCurrents(self, sliceIdx, trigger: Trigger = None):
         """Set all the shim currents to the values that were computed and saved in the solutions array, for the specified slice"""
 
-        if self.obtainedSolutions():
+        apply = self.getSolutionsToApply(sliceIdx) if self.obtainedSolutions() else None
+        if apply is None:
+            # slices out of the roi have nothing solved for them; there is nothing to send for them
+            self.log(f"No solution to apply for slice {sliceIdx}, leaving the shims as they are.")
+        else:
+            # values the scanner and shim driver already have queued are skipped by the clients themselves
 
             # setting center frequency
-            self.setCenterFrequency(deltaCF=self.getSolutionsToApply(sliceIdx)[0])
+            self.setCenterFrequency(deltaCF=apply[0])
 
             # setting the linear shims
-            self.setLinGradients(linGrad=self.getSolutionsToApply(sliceIdx)[1:4])
+            self.setLinGradients(linGrad=apply[1:4])
 
-            # setting the loop shim currents
-            for i in range(self.shimInstance.numLoops):
-                self.sendSyncedLoopSolution(i, sliceIdx=sliceIdx)
+            # setting the loop shim currents, all in one command
+            currents = apply[4:] + self.principleSols[4:]
+            self.log(f"Queueing the loops to {np.array2string(currents, precision=3)}")
+            self.sendSyncedLoopCurrents(currents)
 
         if trigger is not None:
             trigger.finished.emit()
@@ -927,12 +1160,12 @@ class Tool:
     #             self.setLinGradients()
     #             self.queueTwoFgreSequences()
 
-    #     kickoff_thread(queueAll)
+    #     start = self.exsiInstance.images_ready_count
+    #     queued = self.scanQueuer.submit(queueAll)
 
     #     self.shimInstance.shimZero()
-    #     self.exsiInstance.images_ready_event.clear()
     #     num_scans = (self.shimInstance.numLoops + 4) * 2
-    #     if self.countScansCompleted(num_scans):
+    #     if self.countScansCompleted(num_scans, start):
     #         self.log("DEBUG: just finished all the shim eval scans")
     #         self.evaluateAppliedShims(sliceIdx)
     #     else:
@@ -957,13 +1190,9 @@ class Tool:
 
     #     self.log(f"DEBUG: ________________________Do All Shim Scans____________________________________")
     #     # compute how many scans needed, i.e. how many slices are not Nans out of the ROI
-    #     startIdx = None
-    #     numindex = 0
-    #     for i in range(self.backgroundB0Map.shape[1]):
-    #         if self.shimStatsPerSlice[1][i] is not None:
-    #             numindex += 1
-    #             if startIdx is None:
-    #                 startIdx = i
+    #     # the slices are taken as they are, so a gap in the mask doesn't shift the ones after it
+    #     sliceIdxs = np.flatnonzero([stats is not None for stats in self.shimStatsPerSlice[1]])
+    #     numindex = len(sliceIdxs)
 
     #     if numindex == 0:
     #         self.log("Error: No slices to shim")
@@ -971,38 +1200,42 @@ class Tool:
     #             trigger.finished.emit()
     #         return
 
-    #     self.log(f"DEBUG: Starting at index {startIdx} and doing {numindex} B0MAPS")
-    #     self.exsiInstance.images_ready_event.clear()
+    #     self.log(f"DEBUG: Starting at index {sliceIdxs[0]} and doing {numindex} B0MAPS")
+    #     start = self.exsiInstance.images_ready_count
 
     #     def queueAll():
-    #         for i in range(startIdx, startIdx + numindex):
-    #             if i > startIdx:
-    #                 self.exsiInstance.sendWaitForImagesCollected()
+    #         # no WaitImagesReady between the slices: the exsi queue already holds every command until the scanner
+    #         # is done with the previous one, so the next slice's currents go out once the last pair is acquired,
+    #         # while its images are still reconstructed and counted below
+    #         for i in sliceIdxs:
     #             self.setAllShimCurrents(i)  # set all of the currents
     #             self.queueB0MapPairScan()
 
-    #     kickoff_thread(queueAll)
+    #     queued = self.scanQueuer.submit(queueAll)
+
+    #     # perform the rest of the per slice updates in one worker, so the shim setting doesn't lag behind too much
+    #     # and the slices are updated in order instead of in a new thread each
+    #     def updateVals(idx):
+    #         self.computeShimmedB0Map(idx)
+    #         self.evaluateShimImages()
+    #         if trigger is not None:
+    #             trigger.finished.emit()
 
-    #     for idx in range(startIdx, startIdx + numindex):
+    #     updatePool = ThreadPoolExecutor(max_workers=1)
+    #     for n, idx in enumerate(sliceIdxs):
     #         self.log(f"-------------------------------------------------------------")
-    #         self.log(f"DEBUG: STARTING B0MAP {idx-startIdx+1} / {numindex}; slice {idx}")
+    #         self.log(f"DEBUG: STARTING B0MAP {n+1} / {numindex}; slice {idx}")
     #         self.log(f"DEBUG: solutions for this slice are {self.solutionsPerSlice[idx]}")
     #         self.log(f"DEBUG: applied values for this slice are {self.solutionValuesToApplyPerSlice[idx]}")
 
     #         self.log(f"DEBUG: now waiting to actually perform the slice")
-    #         if self.countScansCompleted(2):
-    #             # perform the rest of these functions in another thread so that the shim setting doesn't lag behind too much
-    #             def updateVals():
-    #                 self.computeShimmedB0Map(idx)
-    #                 self.evaluateShimImages()
-    #                 if trigger is not None:
-    #                     trigger.finished.emit()
-
-    #             kickoff_thread(updateVals)
+    #         if self.countScansCompleted(2, start + 2 * n):
+    #             updatePool.submit(updateVals, idx)
     #         else:
     #             self.log("Error: Scans didn't complete")
     #             self.exsiInstance.images_ready_event.clear()
     #             self.exsiInstance.ready_event.clear()
+    #     updatePool.shutdown(wait=True)
 
     # NOT UPDATED / VERIFIED
     def saveResults(self):
@@ -1017,94 +1250,132 @@ class Tool:
             dt = dt.strftime("%Y%m%d_%H%M%S")
 
             self.resultsDir = os.path.join(self.config["rootDir"], "results", self.exsiInstance.examNumber, dt)
-            if not os.path.exists(self.resultsDir):
-                os.makedirs(self.resultsDir)
+            os.makedirs(self.resultsDir, exist_ok=True)
             self.log(f"Saving results to {self.resultsDir}")
 
             # pack all the data into one easy to work with numpy array
-            data = []
-            bases = []
             labels = ["Background", "Expected", "Shimmed"]
 
-            lastNotNone = 0
-            vmax = 0
             # apply mask to all of the data
             self.computeMask()
             refs = [self.backgroundB0Map, self.expectedB0Map, self.shimmedB0Map]
-            for i in range(3):
+            # only save data that has been collected so far (PRUNE THE NONEs); one not collected in between stays nan
+            numData = max((i + 1 for i in range(3) if refs[i] is not None), default=1)
+            # fill the output with nans once, and copy only the masked voxels of every map into it; that applies the
+            # mask while copying, without a nan map for the missing ones or a second pass to mask the stack
+            data = np.full((numData,) + self.backgroundB0Map.shape, np.nan, dtype=self.backgroundB0Map.dtype)
+            for i in range(numData):
                 if refs[i] is not None:
-                    data.append(np.copy(refs[i]))
-                    lastNotNone = i
-                    data[i][~self.finalMask] = np.nan
-                    vmax = max(vmax, np.nanmax(np.abs(data[i])))
-
-            data = data[: lastNotNone + 1]  # only save data that has been collected so far (PRUNE THE NONEs)
+                    np.copyto(data[i], refs[i], where=self.finalMask)
+            vmax = np.nanmax(np.abs(data))
+
+            # the basis maps are all collected together, so there either are all of them or none
+            # masked while copying into a preallocated nan stack, like the data above
+            numBases = self.basisB0mapStack.shape[0] if self.basisB0mapStack is not None else 0
+            bases = np.full((numBases,) + self.backgroundB0Map.shape, np.nan, dtype=np.float32)
+            if numBases > 0:
+                np.copyto(bases, self.basisB0mapStack, where=self.finalMask)
+                vmax = max(vmax, np.nanmax(np.abs(bases)))
+
+            # which coronal slices have anything to save, found once for all of the save loops below
+            # the background and bases are non nan everywhere in the mask, so for them the mask alone tells;
+            # expected and shimmed maps can still be nan in slices that weren't computed or scanned yet
+            maskSlices = self.finalMask.any(axis=(0, 2))
+            dataSlices = ~np.isnan(data).all(axis=(1, 3))
+
+            # make all the directories up front; makedirs makes the parents too, and exist_ok skips checking first
+            overlayHistogramDir = os.path.join(self.resultsDir, "overlayedHistogramPerSlice")
+            dirs = [
+                os.path.join(self.resultsDir, label, sub)
+                for label in labels[: len(data)]
+                for sub in ["images", "histograms"]
+            ]
+            dirs += [os.path.join(self.resultsDir, "basisMaps", f"basis{i}") for i in range(len(bases))]
+            if len(data) >= 2:
+                dirs.append(overlayHistogramDir)
+            for d in dirs:
+                os.makedirs(d, exist_ok=True)
 
-            for i in range(len(bases)):
-                if self.basisB0maps[i] is not None:
-                    bases.append(np.copy(self.basisB0maps))
-                    lastNotNone = i
-                    bases[i][~self.finalMask] = np.nan
-                    vmax = max(vmax, np.nanmax(np.abs(bases[i])))
+            # the figures are only collected here (the slices are views, so nothing is copied yet), and rendered once
+            # it is known how many there are
+            numWorkers = self.saveWorkers
+            saves = []
 
-            bases = bases[: lastNotNone + 1]  # only save basismaps that have been collected so far (PRUNE THE NONEs)
+            def submitSave(fn, *args):
+                saves.append((fn, args))
 
             # save individual images and stats
             for i in range(len(data)):
                 imageTypeSaveDir = os.path.join(self.resultsDir, labels[i])
                 imagesDir = os.path.join(imageTypeSaveDir, "images")
                 histDir = os.path.join(imageTypeSaveDir, "histograms")
-                for d in [imageTypeSaveDir, imagesDir, histDir]:
-                    if not os.path.exists(d):
-                        os.makedirs(d)
 
                 self.log(f"Saving slice images and histograms for {labels[i]}")
                 for j in range(data[0].shape[1]):
                     # save a perslice B0Map image and histogram
-                    if not np.isnan(data[i][:, j, :]).all():
-                        saveImage(imagesDir, labels[i], data[i][:, j, :], j, vmax)
-                        saveHistogram(histDir, labels[i], data[i][:, j, :], j)
+                    if dataSlices[i, j]:
+                        submitSave(saveImage, imagesDir, labels[i], data[i][:, j, :], j, vmax)
+                        submitSave(saveHistogram, histDir, labels[i], data[i][:, j, :], j)
 
                 self.log(f"Saving stats for {labels[i]}")
                 # save all the slicewise stats, appended into one file
                 saveStats(imageTypeSaveDir, labels[i], self.shimStatStrsPerSlice[i])
                 # generate and then save Volume wise stats
-                stats, statarr = evaluate(data[i].flatten(), self.debugging)
+                # everything outside the mask is nan already, so only the voxels in it are gathered, once, for both
+                # the stats and the histogram; instead of flattening a copy of the whole volume for each
+                values = np.take(data[i], self.finalMaskIndices)
+                stats, statarr = evaluate(values, self.debugging)
                 saveStats(imageTypeSaveDir, labels[i], stats, volume=True)
 
                 self.log(f"Saving Volume stats for {labels[i]}")
                 # save Volume wise histogram
-                saveHistogram(imageTypeSaveDir, labels[i], data[i], -1)
-
-            for i in range(len(bases)):
-                if bases[i] is not None:
-                    basesDir = os.path.join(self.resultsDir, "basisMaps")
-                    baseDir = os.path.join(basesDir, f"basis{i}")
-                    for d in [basesDir, baseDir]:
-                        if not os.path.exists(d):
-                            os.makedirs(d)
-                    for j in range(bases[i].shape[1]):
-                        if not np.isnan(bases[i][:, j, :]).all():
-                            saveImage(baseDir, f"basis{i}", bases[i][:, j, :], j, vmax)
+                submitSave(saveHistogram, imageTypeSaveDir, labels[i], values, -1)
+
+            for i, basis in enumerate(bases):
+                baseDir = os.path.join(self.resultsDir, "basisMaps", f"basis{i}")
+                for j in range(basis.shape[1]):
+                    if maskSlices[j]:
+                        submitSave(saveImage, baseDir, f"basis{i}", basis[:, j, :], j, vmax)
 
             # save the histogram  all images overlayed
             if len(data) >= 2:
                 self.log(f"Saving overlayed Volume stats for ROI")
-                data = np.array(data)
                 # for the Volume entirely
-                saveHistogramsOverlayed(self.resultsDir, labels, data, -1)
-                # for each slice independently
-                overlayHistogramDir = os.path.join(self.resultsDir, "overlayedHistogramPerSlice")
-                if not os.path.exists(overlayHistogramDir):
-                    os.makedirs(overlayHistogramDir)
-                for j in range(data[0].shape[1]):
-                    if not np.isnan(data[0][:, j, :]).all():
-                        saveHistogramsOverlayed(overlayHistogramDir, labels, data[:, :, j, :], j)
-
-            # save the numpy data
-            np.save(os.path.join(self.resultsDir, "shimData.npy"), data)
-
-            np.save(os.path.join(self.resultsDir, "basis.npy"), bases)
+                submitSave(saveHistogramsOverlayed, self.resultsDir, labels, data, -1)
+                # for each slice independently; in one batch of slices per worker, so each reuses a single figure
+                for sliceIdxs in np.array_split(np.flatnonzero(maskSlices), numWorkers):
+                    if len(sliceIdxs) > 0:
+                        sliceData = data[:, :, sliceIdxs, :]
+                        submitSave(saveHistogramsOverlayedPerSlice, overlayHistogramDir, labels, sliceData, sliceIdxs)
+
+            if numWorkers <= 1 or len(saves) < 4 * numWorkers:
+                # too few figures to be worth handing to the other processes
+                for fn, args in saves:
+                    fn(*args)
+            else:
+                # rendered and written out in other processes, since matplotlib holds the GIL for most of its work;
+                # only a few per worker are in flight at once, so the slices pickled for them stay bounded
+                if self.savePool is None:
+                    # spawn rather than fork, so the workers don't inherit the gui and client threads
+                    self.savePool = ProcessPoolExecutor(
+                        max_workers=numWorkers, mp_context=multiprocessing.get_context("spawn")
+                    )
+                pending = set()
+                for fn, args in saves:
+                    if len(pending) >= 4 * numWorkers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for save in done:
+                            save.result()  # any error saving a figure comes up here
+                    pending.add(self.savePool.submit(fn, *args))
+                # wait for the rest of the figures
+                for save in as_completed(pending):
+                    save.result()
+
+            # save the numpy data; both are plain float stacks by now, so no pickling, and the masked maps compress well
+            np.savez_compressed(
+                os.path.join(self.resultsDir, "shimData.npz"), data=data, labels=np.array(labels[: len(data)])
+            )
+            np.savez_compressed(os.path.join(self.resultsDir, "basis.npz"), bases=bases)
             self.log(f"Done saving results to {self.resultsDir}")
 
         kickoff_thread(helper)
@@ -112,11 +112,12 @@ def extractBasicImageData(dcmSeriesPath, stride=1, offset=0):
     paths = listDicomFiles(dcmSeriesPath)
     if paths is None:
         raise Exception("No Scans Exist Yet In the Local Directory...")
-    data3d = []
-    te = None
-    for i in range(0, len(paths), stride):
-        data = pydicom.dcmread(paths[i + offset])
-        data3d.append(data.pixel_array)
-        te, orientation = extractMetadata(data)
-    data3d = np.stack(data3d, axis=0)
+    paths = paths[offset::stride]
+    # each dicom file holds one slice, so fill a preallocated volume in place instead of stacking copies
+    data = pydicom.dcmread(paths[0])
+    te, orientation = extractMetadata(data)
+    data3d = np.empty((len(paths),) + data.pixel_array.shape, dtype=data.pixel_array.dtype)
+    data3d[0] = data.pixel_array
+    for i in range(1, len(paths)):
+        data3d[i] = pydicom.dcmread(paths[i]).pixel_array
     return data3d, te, orientation
@@ -7,7 +7,7 @@ from datetime import datetime
 
 import numpy as np
 
-from shimTool.utils import execSSHCommand
+from shimTool.utils import execShellCommand
 
 
 class exsi:
@@ -39,6 +39,14 @@ class exsi:
         self.no_failures = threading.Event()  # for when command fails.
         self.no_failures.set()  # set to true initially
         self.prescanDone = threading.Event()  # for when prescan is done
+        # counts every scan whose images are ready, so waiting on several scans can't miss one between waits
+        self.images_ready_count = 0
+        self.images_ready_cond = threading.Condition()
+        self.images_ready_waits = []  # the counts currently waited on, so waiters are only woken once one is reached
+        # the center frequency and shim values last queued, so queueing the same ones again can be skipped;
+        # forgotten when a protocol is loaded, an auto prescan sets them itself, or queued commands get cleared
+        self.queuedPrescanValues = {}
+        self.queuedPrescanValuesLock = threading.Lock()
 
         # queues
         self.command_queue = queue.Queue()  # Command queue
@@ -66,9 +74,10 @@ class exsi:
             self.sendZeroCmd = lambda: shimZeroFunc()
             self.clearShimQueue = lambda: None
 
-        # Clear the Log
-        with open(self.output_file, "w"):
-            pass
+        # Clear the Log, if asked to; otherwise keep appending to it
+        if config.get("resetLogsOnStart", False):
+            with open(self.output_file, "w"):
+                pass
 
         self.connectExsi()
 
@@ -98,17 +107,19 @@ class exsi:
                     cmd = self.command_queue.get(timeout=1)
                     print("EXSI CLIENT DEBUG: Processing command: ", cmd)
                     # check if we need to initialize current switch as well...
-                    pattern = r"(\d+)\s(\d+\.\d+)"
+                    pattern = r"(\d+)\s(-?\d+\.\d+)"
                     if cmd.startswith("X"):
-                        # Proess synced shim current set command. shouldn't queue anything else after this
-                        match = re.match(pattern, cmd)
-                        channel = int(match.group(1))
-                        current = float(match.group(2))
-                        self.sendCurrentCmd(channel, current)
-                        if self.debugging:
-                            print(
-                                f"EXSI CLIENT Debug: SEND SYNC CURRENT COMMAND, channel {channel} current {current:.2f}"
-                            )
+                        # Process synced shim current set commands, either "X channel current"
+                        # or "X_BATCH channel current channel current ...". shouldn't queue anything else after this
+                        for channel, current in re.findall(pattern, cmd):
+                            channel = int(channel)
+                            current = float(current)
+                            self.sendCurrentCmd(channel, current)
+                            if self.debugging:
+                                print(
+                                    f"EXSI CLIENT Debug: SEND SYNC CURRENT COMMAND, channel {channel} current {current:.2f}"
+                                )
+                        self.command_queue.task_done()
                         continue
                     if not "WaitImagesReady" in cmd:
                         # don't send a command if we are just using a dummy message to wait for images to be collected...
@@ -161,12 +172,8 @@ class exsi:
             self.last_command = cmd
             tcmd = b">heartvista:1:" + str(self.counter).encode("utf-8") + b">" + cmd.encode("utf-8")
             self.counter += 1
-            self.s.send(struct.pack("!H", 16))
-            self.s.send(struct.pack("!H", 1000))
-            self.s.send(struct.pack("!I", len(tcmd)))
-            self.s.send(struct.pack("!I", 0))
-            self.s.send(struct.pack("!I", 100))
-            self.s.send(tcmd)
+            # frame the header and the payload together, so the whole command goes out in one write
+            self.s.sendall(struct.pack("!HHIII", 16, 1000, len(tcmd), 0, 100) + tcmd)
             self.send_event.set()
 
     def receive_loop(self):
@@ -195,11 +202,17 @@ class exsi:
                         # set these so that gui can resume control and not sit in wait
                         self.ready_event.set()
                         self.images_ready_event.set()
+                        with self.images_ready_cond:
+                            self.images_ready_cond.notify_all()
                     if is_ready:
                         self.ready_event.set()
                     if images_ready:
                         print(f"EXSI CLIENT DEBUG: setting images_ready_event")
                         self.images_ready_event.set()
+                        with self.images_ready_cond:
+                            self.images_ready_count += 1
+                            if any(self.images_ready_count >= count for count in self.images_ready_waits):
+                                self.images_ready_cond.notify_all()
             except socket.timeout:
                 continue
             except Exception as e:
@@ -207,6 +220,21 @@ class exsi:
                     file.write("Error receiving data: " + str(e) + "\n!!!Please Restart the Client!!!\n")
                 break
 
+    def waitForImagesReady(self, count, timeout=None):
+        """
+        Block until images_ready_count reaches count, a command fails, or the timeout passes.
+        Returns whether the count was reached.
+        """
+        with self.images_ready_cond:
+            self.images_ready_waits.append(count)
+            try:
+                self.images_ready_cond.wait_for(
+                    lambda: self.images_ready_count >= count or not self.no_failures.is_set(), timeout=timeout
+                )
+            finally:
+                self.images_ready_waits.remove(count)
+            return self.images_ready_count >= count
+
     def rcv(self, length=6000):
         data = self.s.recv(length)
         msg = str(data, "UTF-8", errors="ignore")
@@ -307,6 +335,7 @@ class exsi:
         return (success, ready, images_ready)
 
     def clear_command_queue(self):
+        self.forgetQueuedPrescanValues()
         while not self.command_queue.empty():
             try:
                 cmd = self.command_queue.get_nowait()
@@ -330,7 +359,7 @@ class exsi:
         # Command to extract the last successful setting of the shim currents
         print(f"EXSI CLIENT DEBUG: attempting to find the last used gradients")
         command = "tail -n 100 /usr/g/service/log/Gradient.log | grep 'Prescn Success: AS Success' | tail -n 1"
-        output = execSSHCommand(self.host, self.hvPort, self.hvUser, self.hvPassword, command)
+        output = execShellCommand(self.host, self.hvPort, self.hvUser, self.hvPassword, command)
         if output:
             last_line = output[0].strip()
             # Use regex to find X, Y, Z values
@@ -349,7 +378,7 @@ class exsi:
         # function to extract the last bed position from the scanner
         file = "/usr/g/service/log/irmJvm.log"
         command = f"tail -n 500 {file} | grep 'Table Position=' | tail -n 1"
-        output = execSSHCommand(self.host, self.hvPort, self.hvUser, self.hvPassword, command)
+        output = execShellCommand(self.host, self.hvPort, self.hvUser, self.hvPassword, command)
         if output: 
             last_line = output[0].strip()
             match = re.search(r"Table Position=((S|I)\d+)", last_line)
@@ -380,6 +409,8 @@ class exsi:
 
     @requireExsiConnected
     def sendLoadProtocol(self, name):
+        # a freshly loaded protocol may come with its own cf and shim values, so they all get sent again after it
+        self.forgetQueuedPrescanValues()
         self.send('LoadProtocol site path="' + name + '"')
 
     @requireExsiConnected
@@ -409,17 +440,32 @@ class exsi:
     @requireExsiConnected
     def sendPrescan(self, auto=False):
         if auto:
+            self.forgetQueuedPrescanValues()
             self.send("Prescan auto")  # tune the transmit gain and such
         else:
             self.send("Prescan skip")
 
     @requireExsiConnected
     def sendSetCenterFrequency(self, freq: int):
-        self.send(f"Prescan values=hide cf={freq}")
+        self.sendUnlessQueued("cf", freq, f"Prescan values=hide cf={freq}")
 
     @requireExsiConnected
     def sendSetShimValues(self, x: int, y: int, z: int):
-        self.send(f"SetShimValues x={x} y={y} z={z}")
+        self.sendUnlessQueued("shims", (x, y, z), f"SetShimValues x={x} y={y} z={z}")
+
+    def sendUnlessQueued(self, key, value, cmd):
+        """Queue cmd, which sets the scanner's key to value, unless that is already the last value queued for it."""
+        with self.queuedPrescanValuesLock:
+            if self.queuedPrescanValues.get(key) == value:
+                if self.debugging:
+                    print(f"EXSI CLIENT DEBUG: {key} is already set to {value}, skipping")
+                return
+            self.queuedPrescanValues[key] = value
+        self.send(cmd)
+
+    def forgetQueuedPrescanValues(self):
+        with self.queuedPrescanValuesLock:
+            self.queuedPrescanValues.clear()
 
     @requireExsiConnected
     def sendWaitForImagesCollected(self):
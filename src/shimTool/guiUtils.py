@@ -3,11 +3,13 @@ File for all the Utility functions for the GUI
 """
 
 import inspect
+import mmap
+import os
 import time
 from functools import partial
 
 import numpy as np
-from PyQt6.QtCore import QObject, Qt, QThread, pyqtSignal
+from PyQt6.QtCore import QObject, Qt, QThread, QTimer, pyqtSignal
 from PyQt6.QtGui import QImage, QIntValidator, QValidator
 from PyQt6.QtWidgets import (
     QBoxLayout,
@@ -23,26 +25,102 @@ from PyQt6.QtWidgets import (
     QSlider,
 )
 
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    # only available on linux; the log monitors fall back to polling without it
+    INotify = None
+
 
 class LogMonitorThread(QThread):
     update_log = pyqtSignal(str)
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, chunkSize=65536):
         super(LogMonitorThread, self).__init__(parent)
         self.filename = filename
         self.running = True
+        self.chunkSize = chunkSize  # read the log in big chunks instead of line by line
+        self.buffer = b""  # holds a partial line until the rest of it gets written
+        self.pos = 0  # byte offset in the log up to which lines were already emitted
+        # map the log into memory on linux / macOS instead of issuing a read per chunk
+        self.useMmap = os.name == "posix"
+        self.mm = None
+        # tell the kernel the log is read sequentially, and drop already emitted pages from cache every evictBytes
+        self.canFadvise = hasattr(os, "posix_fadvise")
+        self.evictBytes = 64 << 20
+        self.evictedPos = 0
 
     def run(self):
         self.running = True
-        with open(self.filename, "r") as file:
+        fd = os.open(self.filename, os.O_RDONLY)
+        try:
             # Move to the end of the file
-            file.seek(0, 2)
+            self.pos = os.lseek(fd, 0, os.SEEK_END)
+            self.evictedPos = self.pos
+            if self.canFadvise:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if INotify is not None:
+                self.watchLoop(fd)
+            else:
+                self.pollLoop(fd)
+        finally:
+            if self.mm is not None:
+                self.mm.close()
+                self.mm = None
+            os.close(fd)
+
+    def watchLoop(self, fd):
+        """Sleep until the kernel reports that the log was modified, then emit the new lines."""
+        with INotify() as inotify:
+            inotify.add_watch(self.filename, flags.MODIFY)
             while self.running:
-                line = file.readline()
-                if not line:
-                    time.sleep(0.1)  # Sleep briefly to allow for a stop check
-                    continue
-                self.update_log.emit(line)
+                while self.emitNewLines(fd):
+                    pass
+                # the timeout (ms) is only there to allow for a stop check
+                inotify.read(timeout=500)
+
+    def pollLoop(self, fd):
+        """Fallback for when inotify is not available: check the log for new lines every 50 ms."""
+        while self.running:
+            if not self.emitNewLines(fd):
+                time.sleep(0.05)  # Sleep briefly to allow for a stop check
+
+    def readNewBytes(self, fd):
+        """Return (up to chunkSize of) the bytes appended to the log since the last read."""
+        size = os.fstat(fd).st_size
+        if size < self.pos:
+            # the log got cleared, start reading from the top again
+            self.pos = os.lseek(fd, 0, os.SEEK_SET)
+            self.evictedPos = 0
+        if size == self.pos:
+            return b""
+        if not self.useMmap:
+            chunk = os.read(fd, self.chunkSize)
+        else:
+            # remap whenever the writer changed the size of the log
+            if self.mm is None or len(self.mm) != size:
+                if self.mm is not None:
+                    self.mm.close()
+                self.mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            chunk = self.mm[self.pos : min(size, self.pos + self.chunkSize)]
+        self.pos += len(chunk)
+        if self.canFadvise and self.pos - self.evictedPos >= 2 * self.evictBytes:
+            # keep the last evictBytes cached, evict the rest of what was already emitted
+            self.evictedPos = self.pos - self.evictBytes
+            os.posix_fadvise(fd, 0, self.evictedPos, os.POSIX_FADV_DONTNEED)
+        return chunk
+
+    def emitNewLines(self, fd):
+        """Read everything appended to the log since the last call and emit it line by line."""
+        chunk = self.readNewBytes(fd)
+        if not chunk:
+            return False
+        self.buffer += chunk
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines[-1]
+        for line in lines[:-1]:
+            self.update_log.emit(line.decode("utf-8", errors="ignore"))
+        return True
 
     def stop(self):
         self.running = False
@@ -58,6 +136,15 @@ class ImageViewer(QGraphicsView):
         self.viewData = None  # 2D data that the image viewer is currently being set to show
         self.label = label
 
+        # the scene only ever holds one pixmap, so skip the painter state / antialiasing bookkeeping
+        # and just repaint the whole viewport on updates
+        self.setOptimizationFlags(
+            QGraphicsView.OptimizationFlag.DontSavePainterState
+            | QGraphicsView.OptimizationFlag.DontAdjustForAntialiasing
+        )
+        self.setViewportUpdateMode(QGraphicsView.ViewportUpdateMode.FullViewportUpdate)
+        self.setCacheMode(QGraphicsView.CacheModeFlag.CacheBackground)
+
         # TODO issue #7 add color bar
 
     def set_pixmap(self, pixmap):
@@ -139,11 +226,12 @@ def addLabeledSlider(
     return slider
 
 
-def addLabeledSliderAndEntry(layout: QBoxLayout, labelStr: str, updateFunc):
+def addLabeledSliderAndEntry(layout: QBoxLayout, labelStr: str, updateFunc, throttleMs: int = None):
     """
     Add a slider and entry to the layout with the given label
     default with value 0
     On updates, they will update each other and call the updateFunc provided
+    If throttleMs is given, a burst of slider moves only calls updateFunc once the slider settles for that long
     """
     label = QLabel(labelStr)
 
@@ -154,10 +242,20 @@ def addLabeledSliderAndEntry(layout: QBoxLayout, labelStr: str, updateFunc):
 
     entry = QLineEdit()
     entry.setSizePolicy(QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Preferred)
-    entry.setValidator(QIntValidator(0, 0))
+    # parented to the entry so that it lives as long as the entry; updateSliderEntryLimits only adjusts its range
+    entry.setValidator(QIntValidator(0, 0, entry))
     entry.setText(str(0))
 
-    slider.valueChanged.connect(partial(updateSlider, entry, updateFunc))
+    if throttleMs is None:
+        slider.valueChanged.connect(partial(updateSlider, entry, updateFunc))
+    else:
+        timer = QTimer(slider)
+        timer.setSingleShot(True)
+        timer.setInterval(throttleMs)
+        timer.timeout.connect(partial(updateSliderNow, entry, slider, timer, updateFunc))
+        slider.valueChanged.connect(partial(updateSliderThrottled, entry, timer))
+        # don't wait on the timer once the user lets go of the slider
+        slider.sliderReleased.connect(partial(updateSliderNow, entry, slider, timer, updateFunc))
     entry.editingFinished.connect(partial(updateEntry, entry, slider, updateFunc))
 
     labelEntryLayout = QHBoxLayout()
@@ -173,7 +271,10 @@ def updateSliderEntryLimits(LabelSliderEntry: list, minVal: int, maxVal: int, de
     entry = LabelSliderEntry[2] 
     slider.setMinimum(minVal)
     slider.setMaximum(maxVal)
-    entry.setValidator(QIntValidator(minVal, maxVal))
+    # this runs on every slice update, so reuse the validator instead of making a new one each time
+    validator = entry.validator()
+    if validator.bottom() != minVal or validator.top() != maxVal:
+        validator.setRange(minVal, maxVal)
     if defaultVal is not None:
         slider.setValue(defaultVal)
         entry.setText(str(defaultVal))
@@ -221,6 +322,18 @@ def updateSlider(entry: QLineEdit, updateFunc, value: int):
         else:
             updateFunc()
 
+def updateSliderThrottled(entry: QLineEdit, timer: QTimer, value: int):
+    """Update the entry to match the slider right away, but (re)start the timer to call the updateFunc later"""
+    entry.setText(str(value))
+    timer.start()
+
+
+def updateSliderNow(entry: QLineEdit, slider: QSlider, timer: QTimer, updateFunc):
+    """Cancel any pending throttled update, and call the updateFunc with the current slider value"""
+    timer.stop()
+    updateSlider(entry, updateFunc, slider.value())
+
+
 def hideWidgetsInList(widgets):
     for widget in widgets:
         widget.hide()
@@ -256,6 +369,7 @@ class ROIObject:
         self.updated = False
         self.enabled = False
         self.mask = None
+        self.maskKey = None  # the parameters self.mask was computed with
 
     def setROILimits(self, xdim, ydim, zdim):
         self.xdim = xdim
@@ -280,7 +394,9 @@ class ROIObject:
         """
         if not self.enabled:
             return None
-        if self.updated:
+        # only recompute the mask if the roi actually changed since it was last computed
+        key = (tuple(self.sizes), tuple(self.centers), self.xdim, self.ydim, self.zdim)
+        if self.updated and key != self.maskKey:
             # TODO issue #1
             mask = np.zeros((self.ydim, self.zdim, self.xdim), dtype=bool)
             for z in range(self.zdim):
@@ -288,6 +404,7 @@ class ROIObject:
                     for y in range(self.ydim):
                         mask[y, z, x] = self.isIMGPointInROI(x, y, z)
                         self.mask = mask
+            self.maskKey = key
         return self.mask
 
     def isIMGPointInROI(self, x, y, z):
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import numpy as np
@@ -7,6 +8,12 @@ from skimage.restoration import unwrap_phase
 from shimTool.dicomUtils import *
 from shimTool.utils import *
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # optional; the expected map assembly falls back to numpy without it
+    njit = None
+
 
 def compute_b0map(first, second, te1, te2):
     # Naively compute the b0 map using two phase images from the scans with different TEs
@@ -24,22 +31,37 @@ def compute_b0maps(n, localExamRootDir, threshFactor=0.4) -> List[np.ndarray]:
     """Computes the last n b0maps from pairs"""
     seriesPaths = listSubDirs(localExamRootDir)
     seriesPaths = seriesPaths[-n * 2 :]
-    b0maps = []
-    for i in range(0, n * 2, 2):
+
+    def computePair(i):
         phase1, te1, name1 = extractComplexImageData(seriesPaths[i], threshFactor=threshFactor)
         print(f"DEBUG: Extracted te1 {te1}, name1 {name1}")
         phase2, te2, name2 = extractComplexImageData(seriesPaths[i + 1], threshFactor=threshFactor)
         print(f"DEBUG: Extracted te2 {te2}, name2 {name2}")
-        b0map = compute_b0map(phase1, phase2, te1, te2)
-        b0maps.append(b0map)
-    return b0maps
+        # Hz level precision is plenty, float32 halves the memory and bandwidth of every map downstream
+        return compute_b0map(phase1, phase2, te1, te2).astype(np.float32)
 
+    # the pairs are independent; reading the dicoms is mostly waiting on disk, so overlap them in threads
+    with ThreadPoolExecutor(max_workers=max(1, min(8, n))) as executor:
+        return list(executor.map(computePair, range(0, n * 2, 2)))
 
-def subtractBackground(background, b0maps) -> List[np.ndarray]:
+
+def subtractBackground(background, b0maps, valid: np.ndarray = None, out: np.ndarray = None) -> np.ndarray:
+    """
+    Return the b0maps minus background, stacked into one float32 array; indexing it gives the per basis maps.
+    If out is given, the stack is written into it instead of a new array.
+    If a boolean valid array is given, it is cleared in place wherever the background or any basis is nan.
+    """
     # NOTE: Assumes b0maps[0] is background and the rest are loops @ 1 A!!!!
-    bases = []
+    # subtract straight into the stack so the maps are only passed over once, no temporaries then a copy
+    bases = np.empty((len(b0maps),) + background.shape, dtype=np.float32) if out is None else out
+    nans = np.empty(background.shape, dtype=bool) if valid is not None else None
     for i in range(len(b0maps)):
-        bases.append(b0maps[i] - background)
+        np.subtract(b0maps[i], background, out=bases[i], casting="same_kind")
+        if valid is not None:
+            # nans in the background carry through the subtraction, so checking the difference covers both,
+            # and it is checked while the basis just written is still in cache
+            np.isnan(bases[i], out=nans)
+            valid &= ~nans
     return bases
 
 
@@ -50,19 +72,27 @@ def maskOneSlice(mask, sliceIdx) -> np.ndarray:
     return newMask
 
 
-def createMask(background: np.ndarray, bases: List[np.ndarray], roi: np.ndarray) -> np.ndarray:
-    """Create 3d boolean mask from background, bases and ROI"""
+def createMask(
+    background: np.ndarray, bases: List[np.ndarray], roi: np.ndarray, valid: np.ndarray = None
+) -> np.ndarray:
+    """
+    Create 3d boolean mask from background, bases and ROI.
+    valid can be given instead of recomputing where the background and bases are not nan, as from subtractBackground.
+    """
     # require that one of background, bases and roi is not None
     if background is None and np.array([base is None for base in bases]).any() and roi is None:
         raise ShimComputeError("At least one of background, bases or roi must be provided")
 
     masks = []
-    if background is not None:
-        masks.append(~np.isnan(background))
+    if valid is not None:
+        masks.append(valid)
+    else:
+        if background is not None:
+            masks.append(~np.isnan(background))
 
-    if np.array([base is not None for base in bases]).all():
-        for base in bases:
-            masks.append(~np.isnan(base))
+        if np.array([base is not None for base in bases]).all():
+            for base in bases:
+                masks.append(~np.isnan(base))
 
     # then add roi if there is one; should already be boolean mask
     if roi is not None:
@@ -76,60 +106,57 @@ def createMask(background: np.ndarray, bases: List[np.ndarray], roi: np.ndarray)
     return mask
 
 
-def solveCurrents(
-    background: np.ndarray,
-    rawBases: List[np.ndarray],
-    mask: np.ndarray,
+def sliceNormalEquations(background: np.ndarray, basisStack: np.ndarray, indices: np.ndarray, sliceStarts: np.ndarray):
+    """
+    Split the least squares problem A x ≈ y over the mask into the contribution of every coronal slice.
+    The columns of A are a constant (for the center frequency) and each basis map, y is the background.
+    indices are the flat indices of the masked voxels grouped by slice; slice s has sliceStarts[s]:sliceStarts[s+1].
+    Returns AᵀA (slices x n x n), Aᵀy (slices x n), and the number of masked voxels in every slice.
+    The slices don't overlap, so the problem over any group of slices is just the sum of their contributions.
+    """
+    # only gather the masked voxels, the rest of the volume would just be zero rows in A
+    columns = np.empty((basisStack.shape[0] + 1, len(indices)), dtype=np.float64)
+    columns[0] = 1  # the constant basis for center frequency calc
+    columns[1:] = basisStack.reshape(basisStack.shape[0], -1)[:, indices]
+    y = background.ravel()[indices].astype(np.float64)
+
+    numSlices = len(sliceStarts) - 1
+    ata = np.zeros((numSlices,) + (columns.shape[0],) * 2)
+    aty = np.zeros((numSlices, columns.shape[0]))
+    for s in np.flatnonzero(np.diff(sliceStarts)):
+        sliceColumns = columns[:, sliceStarts[s] : sliceStarts[s + 1]]
+        ata[s] = sliceColumns @ sliceColumns.T
+        aty[s] = sliceColumns @ y[sliceStarts[s] : sliceStarts[s + 1]]
+    counts = np.diff(sliceStarts)
+    return ata, aty, counts
+
+
+def solveNormalEquations(
+    ata: np.ndarray,
+    aty: np.ndarray,
+    numVoxels: int,
     gradientCalStrength,
     loopCalStrength,
     debug=False,
     gradientMax_ticks=100,
     loopMaxCurrent_mA=2000,
 ) -> np.ndarray:
-    # make a copy so that we can work with that instead
-    bases = []
-
-    bases.append(np.ones(background.shape))  # add the constant basis for center frequency calc
-    for rawBase in rawBases:
-        bases.append(rawBase.copy())
-
-    vectorized = []
-    for i in range(len(bases)):
-        masked = bases[i][mask]
-        # if debug:
-        # print(f"DEBUG: vector {i} has nans : {np.isnan(masked).any()}")
-        vectorized.append(masked)
-
-    # Craft the constrained Least Squares Problem
-    A = np.stack(vectorized, axis=1)
-    y = background[mask]
-
-    if y.size == 0 or A.size == 0:
+    """Solve the constrained least squares problem for the currents, given its AᵀA and Aᵀy"""
+    if numVoxels == 0:
         return None
+    numBases = ata.shape[0] - 1
 
-    # if debug:
-    # print and check if A or y still have nans
-    # print(f"DEBUG: A has nans: {np.isnan(A).any()}, y has nans: {np.isnan(y).any()}")
-    # print(f"DEBUG: A.shape {A.shape}, A.T.shape {A.T.shape}, y.shape: {y.shape}")
-    # print(f"DEBUG: y.mean: {np.mean(y)}, y.std: {np.std(y)} y.min: {np.min(y)}, y.max: {np.max(y)}")
-    p = 2 * A.T @ A
-    q = 2 * y.T @ A
+    # Craft the constrained Least Squares Problem
+    p = 2 * ata
+    q = 2 * aty
 
     # constraint vectors
-    g = np.vstack((np.eye(len(rawBases) + 1), -np.eye(len(rawBases) + 1)))  # plus 4 for cf and 3 lin grads
+    g = np.vstack((np.eye(numBases + 1), -np.eye(numBases + 1)))  # plus 4 for cf and 3 lin grads
     h = np.ones(1) * 2000  # for the center frequency in hz
     h = np.concatenate((h, gradientMax_ticks / (np.ones(3) * gradientCalStrength)))  # for the linear gradients
-    h = np.concatenate((h, loopMaxCurrent_mA / (np.ones(len(rawBases) - 3) * loopCalStrength)))
+    h = np.concatenate((h, loopMaxCurrent_mA / (np.ones(numBases - 3) * loopCalStrength)))
     h = np.concatenate((h, h))  # double it for the negative constraints
 
-    # TODO(rob): fix these debug comments to show less
-    # if debug:
-    # print(f"A.shape {A.shape}, y.shape: {y.shape}")
-    # print(f"p.shape {p.shape}, q.shape: {y.shape}, g.shape {g.shape}, h.shape: {h.shape}")
-    # print(p)
-    # print(g)
-    # print(h)
-
     try:
         solvers.options["show_progress"] = False
         res = solvers.qp(matrix(p), matrix(q), matrix(g), matrix(h))
@@ -142,6 +169,64 @@ def solveCurrents(
     return np.array(res["x"]).flatten()
 
 
+def solveCurrents(
+    background: np.ndarray,
+    rawBases: List[np.ndarray],
+    mask: np.ndarray,
+    gradientCalStrength,
+    loopCalStrength,
+    debug=False,
+    gradientMax_ticks=100,
+    loopMaxCurrent_mA=2000,
+) -> np.ndarray:
+    """Solve the currents for the bases over the whole mask"""
+    # the whole mask is one problem, so all of its voxels can go in as a single group
+    indices = np.flatnonzero(mask)
+    sliceStarts = np.array([0, len(indices)])
+    ata, aty, counts = sliceNormalEquations(background, np.stack(rawBases, axis=0), indices, sliceStarts)
+    return solveNormalEquations(
+        ata.sum(axis=0),
+        aty.sum(axis=0),
+        counts.sum(),
+        gradientCalStrength,
+        loopCalStrength,
+        debug=debug,
+        gradientMax_ticks=gradientMax_ticks,
+        loopMaxCurrent_mA=loopMaxCurrent_mA,
+    )
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _assembleExpectedB0Map(background, basisStack, sols, out):
+        # one pass over the output per slice: background + cf, then one fused multiply add per basis
+        # slices with a nan solution row come out nan, like the numpy version
+        for s in prange(background.shape[1]):
+            for a in range(background.shape[0]):
+                for b in range(background.shape[2]):
+                    out[a, s, b] = background[a, s, b] + sols[s, 0]
+                for l in range(basisStack.shape[0]):
+                    coeff = sols[s, l + 1]
+                    for b in range(background.shape[2]):
+                        out[a, s, b] += coeff * basisStack[l, a, s, b]
+
+
+def assembleExpectedB0Map(background: np.ndarray, basisStack: np.ndarray, sols: np.ndarray) -> np.ndarray:
+    """
+    Return the expected b0 map when every coronal slice s is shimmed with its own solution sols[s].
+    sols has one row per slice: the cf offset then the multiple of every basis; a row of nans gives a nan slice.
+    """
+    dtype = np.result_type(background, basisStack)
+    if njit is not None:
+        out = np.empty(background.shape, dtype=dtype)
+        _assembleExpectedB0Map(background, basisStack, sols, out)
+        return out
+    # expected[:, s, :] = background[:, s, :] + cf[s] + sum_l sols[s, l] * basis[l][:, s, :]
+    sols = sols.astype(dtype)  # so the result stays in the maps' precision
+    return background + sols[:, 0][np.newaxis, :, np.newaxis] + np.einsum("sl,lasb->asb", sols[:, 1:], basisStack)
+
+
 def evaluate(d, debug=False):
     """Evaluate a vector with basic stats"""
     std_og = np.nanstd(d)
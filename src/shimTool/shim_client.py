@@ -28,13 +28,18 @@ class shim:
         self.numLoops = 0
         self.loopCurrents = [0 for _ in range(self.numLoops)]
         self.calibrated = False
+        # the current last queued per channel, so setting a channel to what it is already set to can be skipped;
+        # forgotten whenever the driver may have changed the currents on its own (calibrate, zero, cleared queue)
+        self.queuedCurrents = {}
+        self.queuedCurrentsLock = threading.Lock()
 
         # this gets set in the Exsi Gui
         self.clearExsiQueue = lambda: None
 
-        # Clear the Log
-        with open(self.outputFile, "w"):
-            pass
+        # Clear the Log, if asked to; otherwise keep appending to it
+        if config.get("resetLogsOnStart", False):
+            with open(self.outputFile, "w"):
+                pass
 
         # Init the connection
         try:
@@ -191,6 +196,12 @@ class shim:
         else:
             # Else, queue up the command so they can be sent in order.
             self.commandQueue.put(cmd)
+        if cmd in ("C", "Z"):
+            self.forgetQueuedCurrents()
+
+    def forgetQueuedCurrents(self):
+        with self.queuedCurrentsLock:
+            self.queuedCurrents.clear()
 
     def _sendCommand(self, cmd):
         if cmd is not None:
@@ -199,6 +210,8 @@ class shim:
             self.ser.write(cmd.encode())
 
     def clearCommandQueue(self):
+        # some of the cleared commands might have been current sets, so what is queued isn't known anymore
+        self.forgetQueuedCurrents()
         while not self.commandQueue.empty():
             try:
                 cmd = self.commandQueue.get_nowait()
@@ -235,7 +248,7 @@ class shim:
             if not self.connectedEvent.is_set() and not self.debugging:
                 # Show a message to the user, reconnect shim client.
                 raise ShimDriverError("SHIM Client Not Connected")
-            return func(self)
+            return func(self, *args, **kwargs)
 
         return wrapper
 
@@ -265,7 +278,13 @@ class shim:
     @requireShimDriverConnected
     def shimSetCurrentManual(self, channel, current):
         """helper function to set the current for a specific channel on a specific board."""
-        self.send(f"X {channel // 8} {channel % 8} {current}")
+        with self.queuedCurrentsLock:
+            if self.queuedCurrents.get(channel) == current:
+                if self.debugging:
+                    print(f"SHIM CLIENT Debug: channel {channel} is already set to {current}, skipping")
+                return
+            self.queuedCurrents[channel] = current
+            self.send(f"X {channel // 8} {channel % 8} {current}")
 
 
 class ShimDriverError(Exception):
@@ -1,13 +1,16 @@
 import json
 import os
+import queue
 import re
+import shlex
+import stat
 import subprocess
 import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 import numpy as np
-import paramiko
-from matplotlib import pyplot as plt
 
 from shimTool.guiUtils import *
 
@@ -17,6 +20,11 @@ def load_config(filename):
         return json.load(file)
 
 
+# open log files, kept around so that every log call doesn't reopen the file
+_logFiles = {}
+_logLock = threading.Lock()
+
+
 def log(msg, stdout=False):
     # record a timestamp and prepend to the message
     # TODO
@@ -28,8 +36,11 @@ def log(msg, stdout=False):
     # only print if in debugging mode, or if forceStdOut is set to True
     if stdout:
         print(msg)
-    # always write to the log file
-    with open(guilog, "a") as file:
+    # always write to the log file; line buffered so the gui log monitor sees every line as it is written
+    with _logLock:
+        file = _logFiles.get(guilog)
+        if file is None:
+            file = _logFiles[guilog] = open(guilog, "a", buffering=1)
         file.write(f"{msg}\n")
 
 
@@ -39,6 +50,36 @@ def kickoff_thread(target, args=()):
     t.start()
 
 
+class SerialThread:
+    """
+    Run the submitted functions one after the other on a single daemon thread, returning a Future for each.
+    Unlike a ThreadPoolExecutor, a function that never returns doesn't keep the app from exiting.
+    """
+
+    def __init__(self):
+        self.tasks = queue.Queue()
+        kickoff_thread(self.run)
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.tasks.put((future, fn, args))
+        return future
+
+    def shutdown(self):
+        """Stop the thread once the functions submitted before are done."""
+        self.tasks.put(None)
+
+    def run(self):
+        while (task := self.tasks.get()) is not None:
+            future, fn, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+
 def launchInThread(func):
     """Decorator to run a function in a separate thread."""
 
@@ -50,30 +91,34 @@ def launchInThread(func):
 
 def saveImage(directory, title, b0map, slice_index, vmax, white=False):
     """Save B0MAP of either background, estimation, or actual to a file."""
+    # a standalone Figure instead of pyplot, which keeps global state; so images can be saved from several threads
+    # matplotlib is slow to import and only needed once results get saved, so it is imported here to keep startup fast
+    from matplotlib.figure import Figure
 
     if b0map is None:
         return None
     name = f"{title} B0 Map Slice:{slice_index} (Hz)"
     output_path = os.path.join(directory, f"{title}_{slice_index}" + ".png")
 
-    fig, ax = plt.subplots(figsize=(8, 6))
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
     im = ax.imshow(b0map, cmap="jet", vmin=-vmax, vmax=vmax)
-    cbar = plt.colorbar(im)
+    cbar = fig.colorbar(im, ax=ax)
 
     if white:
         # Set colorbar tick labels to white
         cbar.ax.yaxis.set_tick_params(color="white")
         # Set the color of the tick labels to white
-        plt.setp(plt.getp(cbar.ax.axes, "yticklabels"), color="white")
+        for label in cbar.ax.get_yticklabels():
+            label.set_color("white")
 
     if white:
-        plt.title(name, color="white", size=10)
+        ax.set_title(name, color="white", size=10)
     else:
-        plt.title(name, size=10)
-    plt.axis("off")
+        ax.set_title(name, size=10)
+    ax.axis("off")
 
     fig.savefig(output_path, bbox_inches="tight", transparent=white)
-    plt.close(fig)
     return output_path
 
 
@@ -99,7 +144,10 @@ def saveStats(directory, title, stats, volume=False):
 
 def saveHistogram(directory, title, data, slice_index):
     """Save a histogram of the data of either background, estimation, actual at slice or over Full ROI to a file."""
-    fig, ax = plt.subplots()
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots()
     flatdata = data.flatten()
     # ignore nans:
     flatdata = flatdata[~np.isnan(flatdata)]
@@ -115,30 +163,55 @@ def saveHistogram(directory, title, data, slice_index):
         output_path = os.path.join(directory, f"{title}_Volume_Histogram.png")
 
     fig.savefig(output_path, bbox_inches="tight", transparent=False)
-    plt.close(fig)
     return output_path
 
 
 def saveHistogramsOverlayed(directory, titles, data, slice_index):
     """Save a histogram of the data of background, estimation, actual overlayed at slice or over Full ROI to a file."""
-    fig, ax = plt.subplots()
+    from matplotlib.figure import Figure
+
     print(f"UTILS debug: saving histogram overlayed with data shape: {data.shape}, index: {slice_index}")
-    if data.shape[0] == 3 or data.shape[0] == 2:  # either background and est ; or back, est, and actual
-        for i in range(data.shape[0]):
-            makesurenottooverwrite = data[i].flatten()
-            # ignore nans:
-            makesurenottooverwrite = makesurenottooverwrite[~np.isnan(makesurenottooverwrite)]
-            ax.hist(
-                makesurenottooverwrite,
-                bins=100,
-                alpha=0.7,
-                rwidth=0.85,
-                label=titles[i],
-                density=True,
-            )
-    else:
+    if not (data.shape[0] == 3 or data.shape[0] == 2):  # either background and est ; or back, est, and actual
+        print(f"DEBUG: not expected data shape, first dimension is not 3")
+        return
+    fig = Figure()
+    ax = fig.subplots()
+    return plotHistogramsOverlayed(fig, ax, directory, titles, data, slice_index)
+
+
+def saveHistogramsOverlayedPerSlice(directory, titles, data, slice_indices):
+    """
+    Save the overlayed histograms of saveHistogramsOverlayed for several coronal slices, reusing one figure.
+    data[:, :, k, :] holds the maps of slice slice_indices[k].
+    """
+    from matplotlib.figure import Figure
+
+    if not (data.shape[0] == 3 or data.shape[0] == 2):
         print(f"DEBUG: not expected data shape, first dimension is not 3")
         return
+    fig = Figure()
+    ax = fig.subplots()
+    output_paths = []
+    for k, slice_index in enumerate(slice_indices):
+        ax.clear()
+        output_paths.append(plotHistogramsOverlayed(fig, ax, directory, titles, data[:, :, k, :], slice_index))
+    return output_paths
+
+
+def plotHistogramsOverlayed(fig, ax, directory, titles, data, slice_index):
+    """Plot the overlayed histograms of the maps in data on ax, and save fig."""
+    for i in range(data.shape[0]):
+        makesurenottooverwrite = data[i].flatten()
+        # ignore nans:
+        makesurenottooverwrite = makesurenottooverwrite[~np.isnan(makesurenottooverwrite)]
+        ax.hist(
+            makesurenottooverwrite,
+            bins=100,
+            alpha=0.7,
+            rwidth=0.85,
+            label=titles[i],
+            density=True,
+        )
     ax.legend()
     ax.set_xlabel("Offresonance (Hz)")
     if slice_index >= 0:
@@ -148,48 +221,238 @@ def saveHistogramsOverlayed(directory, titles, data, slice_index):
         ax.set_title("Offresonance Over Full ROI")
         output_path = os.path.join(directory, f"overlayed_histograms_Volume.png")
     fig.savefig(output_path, bbox_inches="tight", transparent=False)
-    plt.close(fig)
     return output_path
 
     ##### OTHER METHODS ######
 
 
+# authenticated ssh clients, keyed by (host, port, user), so that each command doesn't redo the handshake
+_sshClients = {}
+_sftpClients = {}
+_sshLock = threading.Lock()
+# interactive shells kept open on those connections, for short commands that would otherwise each open a channel
+_shellChannels = {}
+_shellLock = threading.Lock()
+
+
+def getSSHClient(host, hvPort, hvUser, hvPassword):
+    """Return a cached ssh client connected to the host. (Re)connects if there is none or its transport died."""
+    # paramiko is slow to import and only needed once ssh is used, so it is imported here to keep startup fast
+    import paramiko
+
+    key = (host, hvPort, hvUser)
+    with _sshLock:
+        client = _sshClients.get(key)
+        transport = client.get_transport() if client is not None else None
+        if transport is None or not transport.is_active():
+            if client is not None:
+                client.close()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # Automatically add host key
+            client.connect(
+                hostname=host,
+                port=hvPort,
+                username=hvUser,
+                password=hvPassword,
+                look_for_keys=False,
+                allow_agent=False,
+            )
+            _sshClients[key] = client
+        return client
+
+
+def closeSSHClients():
+    """Close every cached ssh client. They get lazily reopened if a command is issued afterwards."""
+    with _shellLock:
+        for channel in _shellChannels.values():
+            channel.close()
+        _shellChannels.clear()
+    with _sshLock:
+        for sftp in _sftpClients.values():
+            sftp.close()
+        _sftpClients.clear()
+        for client in _sshClients.values():
+            client.close()
+        _sshClients.clear()
+
+
 def execSSHCommand(host, hvPort, hvUser, hvPassword, command):
-    # Initialize the SSH client
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # Automatically add host key
     try:
-        client.connect(hostname=host, port=hvPort, username=hvUser, password=hvPassword)
+        client = getSSHClient(host, hvPort, hvUser, hvPassword)
         stdin, stdout, stderr = client.exec_command(command)
         return stdout.readlines()  # Read the output of the command
 
     except Exception as e:
         print(f"Connection or command execution failed: {e}")
-    finally:
-        client.close()
-
-
-def execRsyncCommand(hvPass, hvUser, host, source, destination):
-    # Construct the SCP command using sshpass
-    cmd = f"sshpass -p {hvPass} rsync -avz {hvUser}@{host}:{source} {destination}"
-
-    # Execute the SCP command
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # Wait for the command to complete
-    stdout, stderr = process.communicate()
+        # drop the cached client so that the next call reconnects from scratch
+        with _sshLock:
+            client = _sshClients.pop((host, hvPort, hvUser), None)
+        if client is not None:
+            client.close()
+
+
+def runInShell(channel, command, timeout=10):
+    """Run a command in an open shell channel and return everything it printed."""
+    # the exit code gets printed right after the marker; wait for the full line so nothing spills into the next call
+    marker = uuid.uuid4().hex
+    pattern = re.compile(marker.encode("utf-8") + rb"(\d+)\r?\n")
+    channel.settimeout(timeout)
+    channel.send(f"{command}; echo {marker}$?\n")
+    output = b""
+    match = None
+    while match is None:
+        data = channel.recv(4096)
+        if not data:
+            raise EOFError("Shell channel closed before the command finished")
+        output += data
+        match = pattern.search(output)
+    return output[: match.start()].decode("utf-8", errors="ignore")
+
+
+def getShellChannel(host, hvPort, hvUser, hvPassword):
+    """Return a cached interactive shell on the cached ssh connection. Must be called with the _shellLock held."""
+    client = getSSHClient(host, hvPort, hvUser, hvPassword)
+    key = (host, hvPort, hvUser)
+    channel = _shellChannels.get(key)
+    if channel is None or channel.closed or channel.get_transport() is not client.get_transport():
+        channel = client.invoke_shell()
+        # turn off the echo and prompts so only the command output comes back; this also drains the login banner
+        runInShell(channel, "stty -echo; PS1=''; PS2=''")
+        _shellChannels[key] = channel
+    return channel
+
+
+def execShellCommand(host, hvPort, hvUser, hvPassword, command):
+    """
+    Run a short command through the cached shell, and return the output lines like execSSHCommand does.
+    Saves opening a new channel per command; long running commands should still use execSSHCommand.
+    """
+    with _shellLock:
+        try:
+            channel = getShellChannel(host, hvPort, hvUser, hvPassword)
+            return runInShell(channel, command).splitlines(keepends=True)
+        except Exception as e:
+            print(f"Shell command execution failed: {e}")
+            # drop the shell so that the next call opens a fresh one
+            channel = _shellChannels.pop((host, hvPort, hvUser), None)
+            if channel is not None:
+                channel.close()
+
+
+def execRsyncCommand(hvPass, hvUser, host, source, destination, files=None):
+    # Run rsync through sshpass without a local shell; sshpass -e reads the password from the environment
+    # so that it never shows up in the process list
+    # if files is given, only those paths (relative to the source directory) are transferred, in one session
+    cmd = ["sshpass", "-e", "rsync", "-avz", "--partial"]
+    if files is not None:
+        cmd.append("--files-from=-")
+    cmd += [f"{hvUser}@{host}:{source}", destination]
+    fileList = "\n".join(files).encode("utf-8") if files is not None else None
+    process = subprocess.run(cmd, input=fileList, env={**os.environ, "SSHPASS": hvPass}, capture_output=True)
 
     # Check if the command was executed successfully
     if process.returncode == 0:
-        return stdout.decode("utf-8")
+        return process.stdout.decode("utf-8")
     else:
-        return f"Error: {stderr.decode('utf-8')}"
+        return f"Error: {process.stderr.decode('utf-8')}"
+
+
+def getSFTPClient(host, hvPort, hvUser, hvPassword):
+    """Return a cached sftp session running over the cached ssh connection to the host."""
+    client = getSSHClient(host, hvPort, hvUser, hvPassword)
+    key = (host, hvPort, hvUser)
+    with _sshLock:
+        sftp = _sftpClients.get(key)
+        channel = sftp.get_channel() if sftp is not None else None
+        if channel is None or channel.closed or channel.get_transport() is not client.get_transport():
+            sftp = client.open_sftp()
+            _sftpClients[key] = sftp
+        return sftp
+
+
+def sftpListTree(sftp, remoteDir, localDir):
+    """
+    Walk remoteDir and return ([(remotePath, localPath, attr)], numFiles): every file that needs to be
+    transferred, and how many remote files were seen in total.
+    Files that already exist locally with the same size and an mtime at least as new are skipped, like rsync would.
+    Local directories are created along the way.
+    """
+    os.makedirs(localDir, exist_ok=True)
+    todo = []
+    numFiles = 0
+    # one listdir_attr per directory gets the size and mtime of every entry without a stat round trip each
+    for attr in sftp.listdir_attr(remoteDir):
+        remotePath = remoteDir.rstrip("/") + "/" + attr.filename
+        localPath = os.path.join(localDir, attr.filename)
+        if stat.S_ISDIR(attr.st_mode):
+            subTodo, subNumFiles = sftpListTree(sftp, remotePath, localPath)
+            todo += subTodo
+            numFiles += subNumFiles
+            continue
+        numFiles += 1
+        try:
+            localStat = os.stat(localPath)
+            if localStat.st_size == attr.st_size and int(localStat.st_mtime) >= int(attr.st_mtime):
+                continue
+        except FileNotFoundError:
+            pass
+        todo.append((remotePath, localPath, attr))
+    return todo, numFiles
+
+
+def sftpDownload(channels: queue.Queue, remotePath, localPath, attr):
+    """Download one file using whichever sftp channel is free in the channels queue."""
+    sftp = channels.get()
+    try:
+        sftp.get(remotePath, localPath)
+    finally:
+        channels.put(sftp)
+    # keep the remote mtime so that the next transfer can skip this file
+    os.utime(localPath, (attr.st_atime, attr.st_mtime))
+
+
+def sftpGetTree(sftp, remoteDir, localDir, maxWorkers=8):
+    """
+    Recursively copy the contents of remoteDir into localDir.
+    The tree is walked with the given sftp session, then the files are fetched concurrently over
+    maxWorkers extra sftp channels on the same ssh transport. sshd caps sessions per connection
+    (MaxSessions, 10 by default), so keep maxWorkers below that.
+    Returns the list of local paths that were transferred.
+    """
+    import paramiko
+
+    todo, numFiles = sftpListTree(sftp, remoteDir, localDir)
+    print(f"Debug: fetching {len(todo)} of {numFiles} files from {remoteDir}")
+    if len(todo) == 0:
+        return []
+
+    numWorkers = min(maxWorkers, len(todo))
+    transport = sftp.get_channel().get_transport()
+    channels = queue.Queue()
+    for _ in range(numWorkers):
+        channels.put(paramiko.SFTPClient.from_transport(transport))
+    try:
+        with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            futures = [executor.submit(sftpDownload, channels, *item) for item in todo]
+            for future in futures:
+                future.result()  # re-raise any transfer errors
+    finally:
+        while not channels.empty():
+            channels.get().close()
+    return [localPath for _, localPath, _ in todo]
+
+
+def execSFTPTransfer(host, hvPort, hvUser, hvPassword, source, destination):
+    """Copy the contents of the remote source directory into the local destination directory over sftp."""
+    sftp = getSFTPClient(host, hvPort, hvUser, hvPassword)
+    return sftpGetTree(sftp, source, destination)
 
 
 def getLastSetGradients(host, hvPort, hvUser, hvPassword):
     # Command to extract the last successful setting of the shim currents
     print(f"Debug: attempting to find the last used gradients")
     command = "tail -n 100 /usr/g/service/log/Gradient.log | grep 'Prescn Success: AS Success' | tail -n 1"
-    output = execSSHCommand(host, hvPort, hvUser, hvPassword, command)
+    output = execShellCommand(host, hvPort, hvUser, hvPassword, command)
     if output:
         last_line = output[0].strip()
         # Use regex to find X, Y, Z values
@@ -204,7 +467,7 @@ def getLastSetGradients(host, hvPort, hvUser, hvPassword):
 
 
 def setGehcExamDataPath(exam_number, host, hvPort, hvUser, hvPassword):
-    output = execSSHCommand(host, hvPort, hvUser, hvPassword, "pathExtract " + exam_number)
+    output = execShellCommand(host, hvPort, hvUser, hvPassword, "pathExtract " + exam_number)
     if output:
         last_line = output[-1].strip()
     else:
@@ -214,29 +477,24 @@ def setGehcExamDataPath(exam_number, host, hvPort, hvUser, hvPassword):
 
 
 def execBashCommand(cmd):
-    # Execute the bash command
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # Wait for the command to complete
-    stdout, stderr = process.communicate()
+    # Execute the command directly, without spawning a shell to parse it. Accepts an argv list or a string.
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    process = subprocess.run(cmd, capture_output=True)
 
     # Check if the command was executed successfully
     if process.returncode == 0:
-        return stdout.decode("utf-8")
+        return process.stdout.decode("utf-8")
     else:
-        return f"Error: {stderr.decode('utf-8')}"
-
+        return f"Error: {process.stderr.decode('utf-8')}"
 
-def execSCPCommand(hvPass, hvUser, hvHost, source, destination):
-    # Construct the SCP command using sshpass
-    cmd = f"sshpass -p {hvPass} scp -r {hvUser}@{hvHost}:{source} {destination}"
 
-    # Execute the SCP command
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # Wait for the command to complete
-    stdout, stderr = process.communicate()
-
-    # Check if the command was executed successfully
-    if process.returncode == 0:
-        return stdout.decode("utf-8")
-    else:
-        return f"Error: {stderr.decode('utf-8')}"
+def execSCPCommand(hvPass, hvUser, hvHost, source, destination, hvPort=22):
+    # Copy the source directory into destination like `scp -r` would, but over the cached sftp session
+    try:
+        execSFTPTransfer(
+            hvHost, hvPort, hvUser, hvPass, source, os.path.join(destination, os.path.basename(source.rstrip("/")))
+        )
+        return ""
+    except Exception as e:
+        return f"Error: {e}"